@@ -0,0 +1,11 @@
+"""
+Benchmarks for the firmware's hot paths.
+
+These run on the unix port of MicroPython or on CPython, from the root of the
+repository:
+
+    micropython -m benchmarks.run
+    python3 -m benchmarks.run --tags 500,5000,50000 --json results.json
+
+They aren't uploaded to the device (see pymakr.conf and mpbridge.ignore).
+"""
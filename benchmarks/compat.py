@@ -0,0 +1,192 @@
+"""
+Shims so firmware modules can be imported off the device.
+
+On CPython the micropython module names (utime, ustruct, ...) are aliased to
+their CPython equivalents, and on both ports the hardware-only modules
+(machine, network) are replaced with stubs that do nothing.
+"""
+
+import sys
+import gc
+
+try:
+    import micropython
+
+    IS_MICROPYTHON = True
+except ImportError:
+    IS_MICROPYTHON = False
+
+
+class _Stub:
+    """Accepts any constructor arguments, method call or attribute."""
+
+    IN = OUT = PULL_UP = PULL_DOWN = IRQ_FALLING = IRQ_RISING = PERIODIC = 0
+    ONE_SHOT = STA_IF = AP_IF = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return None
+
+    def __getattr__(self, name):
+        return _Stub()
+
+
+class _StubModule:
+    def __init__(self, name):
+        self.__name__ = name
+
+    def __getattr__(self, name):
+        return _Stub
+
+
+def _deflate_module():
+    """The parts of micropython's deflate module the firmware uses."""
+    import zlib
+
+    class DeflateIO:
+        def __init__(self, stream, format=0, wbits=0):
+            self._stream = stream
+            self._inflater = zlib.decompressobj(-(wbits or 15))
+
+        def readinto(self, buf):
+            data = self._inflater.unconsumed_tail or self._stream.read(512)
+            data = self._inflater.decompress(data, len(buf))
+            while not data and not self._inflater.eof:
+                chunk = self._inflater.unconsumed_tail or self._stream.read(512)
+                if not chunk:
+                    break
+                data = self._inflater.decompress(chunk, len(buf))
+            buf[: len(data)] = data
+            return len(data)
+
+    module = _StubModule("deflate")
+    module.RAW = 1
+    module.DeflateIO = DeflateIO
+    return module
+
+
+def _alias_cpython_modules():
+    import asyncio
+    import binascii
+    import collections
+    import io
+    import os
+    import random
+    import re
+    import socket
+    import struct
+    import time
+    import builtins
+
+    time.ticks_ms = lambda: int(time.perf_counter() * 1000)
+    time.ticks_us = lambda: int(time.perf_counter() * 1000000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+
+    aliases = {
+        "utime": time,
+        "uio": io,
+        "uos": os,
+        "ubinascii": binascii,
+        "ustruct": struct,
+        "ure": re,
+        "ucollections": collections,
+        "urandom": random,
+        "usocket": socket,
+        "uasyncio": asyncio,
+    }
+    for name, module in aliases.items():
+        sys.modules[name] = module
+
+    sys.modules["deflate"] = _deflate_module()
+
+    # micropython's compile time constants and code emitters
+    builtins.const = lambda value: value
+    stub = _StubModule("micropython")
+    stub.const = builtins.const
+    stub.native = stub.viper = lambda function: function
+    stub.schedule = lambda function, arg: function(arg)
+    sys.modules["micropython"] = stub
+
+
+def install():
+    """Install the shims. Safe to call more than once."""
+    if not IS_MICROPYTHON and "utime" not in sys.modules:
+        _alias_cpython_modules()
+
+    for name in ("machine", "network", "neopixel"):
+        try:
+            __import__(name)
+            if name == "machine" and not hasattr(sys.modules[name], "Pin"):
+                raise ImportError  # the unix port's machine module has no pins
+        except ImportError:
+            sys.modules[name] = _StubModule(name)
+
+
+install()
+
+import utime
+
+
+def ticks_us():
+    return utime.ticks_us()
+
+
+def elapsed_us(start):
+    return utime.ticks_diff(utime.ticks_us(), start)
+
+
+class HeapMeter:
+    """
+    Measures heap use of the code run inside it.
+
+    peak     - the most heap in use at once (on MicroPython the garbage
+               collector is paused, so this is everything allocated)
+    retained - heap still in use once garbage is collected
+    """
+
+    def __enter__(self):
+        gc.collect()
+        if IS_MICROPYTHON:
+            self._start = gc.mem_alloc()
+            gc.disable()
+        else:
+            import tracemalloc
+
+            tracemalloc.start()
+            self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if IS_MICROPYTHON:
+            self.peak = gc.mem_alloc() - self._start
+            gc.enable()
+            gc.collect()
+            self.retained = gc.mem_alloc() - self._start
+        else:
+            import tracemalloc
+
+            self.peak = tracemalloc.get_traced_memory()[1] - self._start
+            gc.collect()
+            self.retained = tracemalloc.get_traced_memory()[0] - self._start
+            tracemalloc.stop()
+
+
+def measure(function):
+    """
+    Time function() and then run it again to measure its heap use (heap
+    tracing slows CPython down too much to do both at once). Anything the
+    function returns counts as retained. Returns (microseconds, HeapMeter).
+    """
+    gc.collect()
+    start = ticks_us()
+    function()
+    us = elapsed_us(start)
+
+    with HeapMeter() as heap:
+        kept = function()
+    del kept
+    return us, heap
@@ -0,0 +1,118 @@
+"""
+Benchmarks for packet encodings: JSON against CBOR, building a dict for each
+packet against the preformatted templates in packets.py, and decoding a tag
+sync. For the small packets size is the encoded packet in bytes, us is per
+packet and heap is for building and encoding one packet. For syncs size is
+the number of tags.
+"""
+
+import json
+
+from benchmarks.compat import measure
+import cbor
+import jsonstream
+import packets
+
+ENCODE_REPEATS = 1000
+
+CARD_ID = "2654435761"
+SESSION_ID = "4f0c2a9e-8d1b-4b7a-9a51-0c1d2e3f4a5b"
+RTT = {"last": 42, "min": 31, "max": 180, "avg": 57, "pings": 12, "pongs": 12}
+
+# name: (build the packet as a dict like main.py used to, template, values)
+PACKETS = {
+    "pong": (lambda: {"command": "pong"}, packets.PONG, ()),
+    "log_access": (
+        lambda: {"command": "log_access", "card_id": CARD_ID},
+        packets.LOG_ACCESS,
+        (CARD_ID,),
+    ),
+    "session_update": (
+        lambda: {
+            "command": "interlock_session_update",
+            "session_id": SESSION_ID,
+            "session_kwh": 1.25,
+        },
+        packets.INTERLOCK_SESSION_UPDATE,
+        (SESSION_ID, 1.25),
+    ),
+    "debit": (
+        lambda: {"command": "debit", "card_id": CARD_ID, "amount": 2.5},
+        packets.DEBIT,
+        (CARD_ID, 2.5),
+    ),
+    "ping": (lambda: {"command": "ping", "rtt": RTT}, packets.PING, (RTT,)),
+}
+
+
+def result(name, size, us, heap):
+    return {
+        "name": name,
+        "size": size,
+        "us": us,
+        "heap_peak": heap.peak,
+        "heap_retained": heap.retained,
+    }
+
+
+def repeat(fn):
+    def run():
+        for _ in range(ENCODE_REPEATS):
+            fn()
+
+    return run
+
+
+def bench_packet(name, make):
+    size = len(make())
+    us, _ = measure(repeat(make))
+    _, heap = measure(make)
+    return result(name, size, round(us / ENCODE_REPEATS, 2), heap)
+
+
+def bench_packets():
+    results = []
+    for name, (make_dict, template, values) in PACKETS.items():
+        for encoding, dumps, encode in (
+            ("json", json.dumps, packets.encode_json),
+            ("cbor", cbor.dumps, packets.encode_cbor),
+        ):
+            results.append(
+                bench_packet(
+                    "%s_dict_%s" % (encoding, name), lambda: dumps(make_dict())
+                )
+            )
+            results.append(
+                bench_packet(
+                    "%s_template_%s" % (encoding, name),
+                    lambda: encode(template(*values)),
+                )
+            )
+    return results
+
+
+def bench_sync(count):
+    ids = [(i * 2654435761) & 0xFFFFFFFF for i in range(1, count + 1)]
+    packets = (
+        (
+            "json",
+            jsonstream,
+            json.dumps({"hash": "abc", "tags": [str(i) for i in ids]}),
+        ),
+        ("cbor", cbor, cbor.dumps({"hash": "abc", "tags": ids})),
+    )
+
+    # the tags are dropped, so only the decoder's own work is measured
+    streams = {"tags": lambda tag: None}
+    results = []
+    for encoding, decoder, packet in packets:
+        us, heap = measure(lambda: decoder.loads(packet, streams))
+        results.append(result("%s_sync_decode" % encoding, count, us, heap))
+    return results
+
+
+def run(counts):
+    results = bench_packets()
+    for count in counts:
+        results.extend(bench_sync(count))
+    return results
@@ -0,0 +1,43 @@
+"""
+Benchmarks for websocket payload masking: the original per-byte generator
+against the masking routine protocol.py now uses (viper on the device, big
+int XOR elsewhere).
+"""
+
+from benchmarks.compat import measure
+from uwebsockets import protocol
+
+MASK_BITS = b"\x12\x34\x56\x78"
+
+
+def mask_generator(data):
+    # what write_frame and read_frame used to do
+    return bytes(b ^ MASK_BITS[i % 4] for i, b in enumerate(data))
+
+
+def result(name, size, us, heap):
+    return {
+        "name": name,
+        "size": size,
+        "us": us,
+        "heap_peak": heap.peak,
+        "heap_retained": heap.retained,
+    }
+
+
+def run(sizes):
+    results = []
+    if protocol.apply_mask is protocol._mask_python:
+        routine = "mask_python"
+    else:
+        routine = "mask_viper"
+    for size in sizes:
+        data = bytes(i & 0xFF for i in range(size))
+        buf = bytearray(data)
+
+        results.append(
+            result("mask_generator", size, *measure(lambda: mask_generator(data)))
+        )
+        us, heap = measure(lambda: protocol.apply_mask(buf, size, MASK_BITS))
+        results.append(result(routine, size, us, heap))
+    return results
@@ -0,0 +1,79 @@
+"""
+Run the benchmarks and print the results. With --json the results are also
+written to a file as a list of objects (name, size, us, heap_peak,
+heap_retained) for comparing runs. size is the number of tags, the frame
+size in bytes or the encoded packet size in bytes.
+
+    python3 -m benchmarks.run [--tags 500,5000,20000,50000] [--frames 1024,65536]
+                              [--json results.json]
+"""
+
+import sys
+import json
+
+from benchmarks import compat
+from benchmarks import encoding
+from benchmarks import masking
+from benchmarks import tags
+
+DEFAULT_TAG_COUNTS = (500, 5000, 20000, 50000)
+DEFAULT_FRAME_SIZES = (1024, 65536, 262144)
+
+
+def parse_args(argv):
+    options = {
+        "tags": DEFAULT_TAG_COUNTS,
+        "frames": DEFAULT_FRAME_SIZES,
+        "json": None,
+    }
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--tags":
+            options["tags"] = [int(count) for count in argv[i + 1].split(",")]
+            i += 1
+        elif argv[i] == "--frames":
+            options["frames"] = [int(size) for size in argv[i + 1].split(",")]
+            i += 1
+        elif argv[i] == "--json":
+            options["json"] = argv[i + 1]
+            i += 1
+        else:
+            raise ValueError("Unknown argument: " + argv[i])
+        i += 1
+    return options
+
+
+def print_result(result):
+    heap = ""
+    if result["heap_peak"] is not None:
+        heap = "%10d peak %10d retained" % (
+            result["heap_peak"],
+            result["heap_retained"],
+        )
+    print(
+        "%-30s %8d %12.2f us %s" % (result["name"], result["size"], result["us"], heap)
+    )
+
+
+def main(argv):
+    options = parse_args(argv)
+    print("micropython" if compat.IS_MICROPYTHON else "cpython", sys.version)
+
+    results = []
+    suites = (
+        (tags, options["tags"]),
+        (masking, options["frames"]),
+        (encoding, options["tags"]),
+    )
+    for suite, sizes in suites:
+        for result in suite.run(sizes):
+            print_result(result)
+            results.append(result)
+
+    if options["json"]:
+        with open(options["json"], "w") as json_file:
+            json.dump(results, json_file)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
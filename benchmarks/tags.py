@@ -0,0 +1,173 @@
+"""
+Benchmarks for the authorisation path: tag lookups, sync ingest and loading
+and saving the tags on flash. The old list-of-strings and tags.json approach
+is included for comparison.
+"""
+
+import json
+import os
+
+from benchmarks.compat import measure, ticks_us, elapsed_us
+import jsonstream
+import tagstore
+
+LOOKUPS = 1000
+TAGS_JSON = "bench_tags.json"
+TAGS_BIN = "bench_tags.bin"
+
+
+def make_tags(count):
+    # spread the IDs over the 32bit range like real mifare UIDs
+    return [str((i * 2654435761) & 0xFFFFFFFF) for i in range(1, count + 1)]
+
+
+def make_probes(tags):
+    # half hits, half (mostly) misses
+    probes = [int(tags[(i * 7919) % len(tags)]) for i in range(LOOKUPS // 2)]
+    return probes + list(range(LOOKUPS // 2))
+
+
+def result(name, count, us, heap=None):
+    return {
+        "name": name,
+        "size": count,
+        "us": round(us, 2),
+        "heap_peak": heap.peak if heap else None,
+        "heap_retained": heap.retained if heap else None,
+    }
+
+
+def time_lookups(store, probes):
+    start = ticks_us()
+    for probe in probes:
+        probe in store
+    return elapsed_us(start) / len(probes)
+
+
+def bench_lookups(count, tags, packet):
+    # us is per lookup, heap is for loading the tags
+    probes = make_probes(tags)
+    results = []
+
+    _, heap = measure(lambda: json.loads(packet)["tags"])
+    as_list = json.loads(packet)["tags"]
+    string_probes = [str(probe) for probe in probes[:100]]
+    us = time_lookups(as_list, string_probes)
+    results.append(result("lookup_list_of_strings", count, us, heap))
+    del as_list
+
+    _, heap = measure(lambda: tagstore.TagStore(tags))
+    store = tagstore.TagStore(tags)
+    results.append(result("lookup_tagstore", count, time_lookups(store, probes), heap))
+    tagstore.write_tag_file(TAGS_BIN, store, "bench")
+    del store
+
+    def open_flash_store():
+        flash_store = tagstore.FlashTagStore(TAGS_BIN)
+        flash_store.open()
+        return flash_store
+
+    _, heap = measure(open_flash_store)
+    flash_store = open_flash_store()
+    us = time_lookups(flash_store, probes)
+    results.append(result("lookup_flash_tagstore", count, us, heap))
+    flash_store.close()
+    return results
+
+
+def bench_sync_ingest(count, packet):
+    def json_loads():
+        return tagstore.TagStore(json.loads(packet)["tags"])
+
+    def stream():
+        store = tagstore.TagStore()
+        jsonstream.loads(packet, {"tags": store.append})
+        store.finish()
+        return store
+
+    return [
+        result("sync_json_loads", count, *measure(json_loads)),
+        result("sync_jsonstream", count, *measure(stream)),
+    ]
+
+
+def bench_files(count, tags):
+    store = tagstore.TagStore(tags)
+
+    def save_json():
+        with open(TAGS_JSON, "w") as tags_file:
+            json.dump(tags, tags_file)
+
+    def load_json():
+        with open(TAGS_JSON) as tags_file:
+            return tagstore.TagStore(json.load(tags_file))
+
+    def save_bin():
+        tagstore.FlashTagStore(TAGS_BIN).replace(store, "bench")
+
+    def load_bin():
+        flash_store = tagstore.FlashTagStore(TAGS_BIN)
+        flash_store.open()
+        return flash_store
+
+    def delta_bin():
+        # add 5 new tags and remove 5, then put them back for the next run
+        flash_store = load_bin()
+        flash_store.apply_delta(range(5), tags[:5], "bench2")
+        flash_store.apply_delta(tags[:5], range(5), "bench")
+        flash_store.close()
+
+    results = [
+        result("save_tags_json", count, *measure(save_json)),
+        result("load_tags_json", count, *measure(load_json)),
+        result("save_tags_bin", count, *measure(save_bin)),
+        result("load_tags_bin", count, *measure(load_bin)),
+    ]
+    us, heap = measure(delta_bin)
+    results.append(result("delta_tags_bin", count, us / 2, heap))
+    return results
+
+
+def bench_boot(count, tags):
+    """
+    The tag store's share of power on to first unlock: opening the saved tags
+    and checking the first card. Boot used to load the whole file before the
+    main loop started, now only the header is read and the first lookup
+    searches the file.
+    """
+    tagstore.write_tag_file(TAGS_BIN, tagstore.TagStore(tags), "bench")
+    card = int(tags[count // 2])
+
+    def first_lookup(background):
+        def boot():
+            flash_store = tagstore.FlashTagStore(TAGS_BIN)
+            flash_store.open(background=background)
+            found = card in flash_store
+            flash_store.close()
+            return found
+
+        return boot
+
+    return [
+        result("boot_first_lookup_blocking", count, *measure(first_lookup(False))),
+        result("boot_first_lookup_background", count, *measure(first_lookup(True))),
+    ]
+
+
+def run(counts):
+    results = []
+    try:
+        for count in counts:
+            tags = make_tags(count)
+            packet = json.dumps({"command": "sync", "hash": "bench", "tags": tags})
+            results += bench_lookups(count, tags, packet)
+            results += bench_sync_ingest(count, packet)
+            results += bench_files(count, tags)
+            results += bench_boot(count, tags)
+    finally:
+        for path in (TAGS_JSON, TAGS_BIN, TAGS_BIN + ".tmp"):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return results
@@ -0,0 +1,297 @@
+"""
+cbor.py - compact binary encoding for portal packets (RFC 8949 CBOR)
+
+JSON spends CPU and heap formatting and parsing text, and sends card IDs and
+numbers as digits. CBOR packets are smaller, and encoding or decoding them is
+mostly copying bytes. The portal can accept CBOR when the device
+authenticates, otherwise packets stay JSON (see PROTOCOL.md).
+
+Only what packets use is supported: ints up to 64 bits, floats, strings,
+bytes, lists, dicts, True, False and None, with definite lengths.
+
+    message = dumps({"command": "log_access", "card_id": 1234567})
+
+StreamDecoder has the same interface as jsonstream.StreamDecoder, so tag
+arrays in a large packet are handed to a callback an element at a time.
+
+    decoder = StreamDecoder({"tags": new_tags.append})
+    decoder.feed(packet)
+    fields = decoder.close()
+"""
+
+import struct
+
+# major types
+_UINT = 0
+_NINT = 1
+_BYTES = 2
+_TEXT = 3
+_ARRAY = 4
+_MAP = 5
+_SIMPLE = 7
+
+_FALSE = 0xF4
+_TRUE = 0xF5
+_NULL = 0xF6
+_FLOAT16 = 0xF9
+_FLOAT32 = 0xFA
+_FLOAT64 = 0xFB
+
+# decoder states
+_START = 0  # waiting for the packet's map header
+_KEY = 1
+_VALUE = 2
+_ARRAY_ELEMENT = 3  # inside a streamed array
+_DONE = 4
+
+
+class _Incomplete(Exception):
+    """The item continues in the next chunk."""
+
+
+def _encode_head(out, major, value):
+    major <<= 5
+    if value < 24:
+        out.append(major | value)
+    elif value < 0x100:
+        out.append(major | 24)
+        out.append(value)
+    elif value < 0x10000:
+        out.append(major | 25)
+        out.extend(value.to_bytes(2, "big"))
+    elif value < 0x100000000:
+        out.append(major | 26)
+        out.extend(value.to_bytes(4, "big"))
+    else:
+        out.append(major | 27)
+        out.extend(value.to_bytes(8, "big"))
+
+
+def encode_into(out, value):
+    """Append value to the bytearray out as CBOR."""
+    # bools first, they're ints too
+    if value is None:
+        out.append(_NULL)
+    elif value is True:
+        out.append(_TRUE)
+    elif value is False:
+        out.append(_FALSE)
+    elif isinstance(value, int):
+        if value >= 0:
+            _encode_head(out, _UINT, value)
+        else:
+            _encode_head(out, _NINT, -1 - value)
+    elif isinstance(value, str):
+        value = value.encode()
+        _encode_head(out, _TEXT, len(value))
+        out.extend(value)
+    elif isinstance(value, dict):
+        _encode_head(out, _MAP, len(value))
+        for key, item in value.items():
+            encode_into(out, key)
+            encode_into(out, item)
+    elif isinstance(value, (list, tuple)):
+        _encode_head(out, _ARRAY, len(value))
+        for item in value:
+            encode_into(out, item)
+    elif isinstance(value, float):
+        # single precision is exact for micropython's floats on the ESP32
+        packed = struct.pack(">f", value)
+        if struct.unpack(">f", packed)[0] == value:
+            out.append(_FLOAT32)
+        else:
+            packed = struct.pack(">d", value)
+            out.append(_FLOAT64)
+        out.extend(packed)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        _encode_head(out, _BYTES, len(value))
+        out.extend(value)
+    else:
+        raise TypeError("Can't encode %s as CBOR" % type(value))
+
+
+def dumps(value):
+    """Encode value as CBOR bytes."""
+    out = bytearray()
+    encode_into(out, value)
+    return bytes(out)
+
+
+def map_header(length):
+    """The start of a map with length entries, for encoding them one at a time."""
+    out = bytearray()
+    _encode_head(out, _MAP, length)
+    return bytes(out)
+
+
+def is_packet(data):
+    """
+    True if data (the start of a websocket message) is a CBOR packet. Packets
+    are maps, and no JSON text starts with a map's first byte.
+    """
+    return not isinstance(data, str) and len(data) and 0xA0 <= data[0] <= 0xBF
+
+
+def _float16(bits):
+    exponent = (bits >> 10) & 0x1F
+    fraction = bits & 0x3FF
+    if exponent == 0:
+        value = fraction * 2.0**-24
+    elif exponent == 0x1F:
+        value = float("nan") if fraction else float("inf")
+    else:
+        value = (1024 + fraction) * 2.0 ** (exponent - 25)
+    return -value if bits & 0x8000 else value
+
+
+def _decode_head(buf, pos):
+    """Return (major type, argument, position after the head)."""
+    if pos >= len(buf):
+        raise _Incomplete()
+    initial = buf[pos]
+    info = initial & 0x1F
+    pos += 1
+    if info < 24:
+        return initial >> 5, info, pos
+    if info > 27:
+        raise ValueError("Unsupported CBOR item: 0x%02x" % initial)
+
+    end = pos + (1 << (info - 24))
+    if end > len(buf):
+        raise _Incomplete()
+    return initial >> 5, int.from_bytes(buf[pos:end], "big"), end
+
+
+def _decode(buf, pos):
+    """Decode the item at pos. Returns (value, position after it)."""
+    start = pos
+    major, arg, pos = _decode_head(buf, pos)
+
+    if major == _UINT:
+        return arg, pos
+    elif major == _NINT:
+        return -1 - arg, pos
+    elif major == _BYTES or major == _TEXT:
+        end = pos + arg
+        if end > len(buf):
+            raise _Incomplete()
+        if major == _TEXT:
+            return str(buf[pos:end], "utf-8"), end
+        return bytes(buf[pos:end]), end
+    elif major == _ARRAY:
+        items = []
+        for _ in range(arg):
+            item, pos = _decode(buf, pos)
+            items.append(item)
+        return items, pos
+    elif major == _MAP:
+        items = {}
+        for _ in range(arg):
+            key, pos = _decode(buf, pos)
+            items[key], pos = _decode(buf, pos)
+        return items, pos
+
+    initial = buf[start]
+    if initial == _FALSE:
+        return False, pos
+    elif initial == _TRUE:
+        return True, pos
+    elif initial == _NULL or initial == _NULL + 1:  # null or undefined
+        return None, pos
+    elif initial == _FLOAT16:
+        return _float16(arg), pos
+    elif initial == _FLOAT32:
+        return struct.unpack(">f", buf[start + 1 : pos])[0], pos
+    elif initial == _FLOAT64:
+        return struct.unpack(">d", buf[start + 1 : pos])[0], pos
+    raise ValueError("Unsupported CBOR item: 0x%02x" % initial)
+
+
+class StreamDecoder:
+    def __init__(self, streams=None):
+        """
+        streams - a dict of top-level key: callback. Elements of an array
+                  under that key are passed to the callback one at a time.
+        """
+        self._streams = streams or {}
+        self._fields = {}
+        self._state = _START
+        self._buf = bytearray()
+        self._key = None
+        self._keys_left = 0
+        self._elements_left = 0
+
+    def feed(self, chunk):
+        """
+        Decode the next chunk (bytes, bytearray or memoryview). Only an item
+        split between chunks is kept until the next one.
+        """
+        if self._buf:
+            buf = self._buf + chunk
+        else:
+            buf = chunk  # decode straight from the chunk, nothing's left over
+        pos = 0
+
+        try:
+            while True:
+                state = self._state
+
+                # the hottest state (tag arrays) is checked first
+                if state == _ARRAY_ELEMENT:
+                    if not self._elements_left:
+                        state = _KEY
+                    else:
+                        element, pos = _decode(buf, pos)
+                        self._elements_left -= 1
+                        self._callback(element)
+                        continue
+
+                if state == _KEY:
+                    if not self._keys_left:
+                        state = _DONE
+                    else:
+                        self._key, pos = _decode(buf, pos)
+                        self._keys_left -= 1
+                        state = _VALUE
+
+                elif state == _VALUE:
+                    self._callback = self._streams.get(self._key)
+                    major, length, end = _decode_head(buf, pos)
+                    if self._callback and major == _ARRAY:
+                        self._fields[self._key] = length
+                        self._elements_left = length
+                        pos = end
+                        state = _ARRAY_ELEMENT
+                    else:
+                        self._fields[self._key], pos = _decode(buf, pos)
+                        state = _KEY
+
+                elif state == _START:
+                    major, self._keys_left, pos = _decode_head(buf, pos)
+                    if major != _MAP:
+                        raise ValueError("CBOR packet isn't a map")
+                    state = _KEY
+
+                self._state = state
+                if state == _DONE:
+                    if pos < len(buf):
+                        raise ValueError("Unexpected data after CBOR packet")
+                    break
+
+        except _Incomplete:
+            pass  # wait for the rest of the item
+
+        self._buf = bytearray(buf[pos:])
+
+    def close(self):
+        """Finish decoding and return a dict of the fields that weren't streamed."""
+        if self._state != _DONE:
+            raise ValueError("Incomplete CBOR packet")
+        return self._fields
+
+
+def loads(data, streams=None):
+    """Decode a complete CBOR packet, streaming the arrays named in streams."""
+    decoder = StreamDecoder(streams)
+    decoder.feed(data)
+    return decoder.close()
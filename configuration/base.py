@@ -65,6 +65,10 @@ VEND_PRICE = 250  # price in cents to debit an account
 # None, "hold" or "toggle" - None disable, hold until the accept coins signal is ready, toggle will hold for VEND_TOGGLE_TIME (s)
 VEND_MODE = None
 VEND_TOGGLE_TIME = 1
+VEND_TIMEOUT = 60  # seconds to wait for the accept coins signal to go low in hold mode before refunding
+VEND_MESSAGE_TIME = 5  # seconds to show the debit result before the standby message
+# seconds to refuse other swipes while waiting for a debit response
+DEBIT_RESPONSE_TIMEOUT = 10
 
 # =========================================================================
 # ============================ LCD Settings ===============================
@@ -107,6 +111,14 @@ WIEGAND_ONE = 6
 # Enables the hardware watchdog timer.
 ENABLE_WDT = False
 
+# Seconds to wait on boot (so you can press CTRL+C) before starting the WDT.
+# This delays boot, so you may want to lower it in production.
+WDT_START_DELAY = 3
+
+# Seconds without a WDT feed before the device resets. The main loop feeds it
+# every pass, so this only has to cover the longest blocking action.
+WDT_TIMEOUT = 15
+
 # Ignore exceptions and continue the event loop
 CATCH_ALL_EXCEPTIONS = False
 
@@ -137,3 +149,45 @@ WIEGAND_TIMER_ID = 0
 
 # every 10 seconds run cron tasks
 CRON_PERIOD = 10 * 1000
+
+# milliseconds of each main loop pass after which background tasks (pings,
+# energy polling, gc) wait for a quieter pass. Swipes are never held up.
+SCHEDULER_IDLE_SLICE = 10
+
+# milliseconds to batch state changes before writing them to flash
+STATE_SAVE_DELAY = 1000
+
+# largest websocket message (in bytes) to hold in RAM at once. Uncompressed
+# packets are decoded a couple of KB at a time as they arrive, so they aren't
+# limited. Compressed packets are held whole until they're decompressed (a
+# 20,000 tag sync is about 115 KB). Bigger ones close the connection.
+WS_MAX_MESSAGE_SIZE = 256 * 1024
+
+# ask the portal to compress websocket packets (permessage-deflate) with a
+# window of 2^N bytes, which is allocated while a packet is decompressed.
+# 9 to 15, or None to turn compression off.
+WS_DEFLATE_WINDOW_BITS = 11
+
+# offer the portal a compact binary encoding (CBOR) for packets, which is
+# smaller and cheaper to encode and decode than JSON. Packets stay JSON if the
+# portal doesn't accept it.
+WS_CBOR_ENCODING = True
+
+# milliseconds to wait for the websocket to connect before giving up. Failed
+# attempts are retried after WS_RECONNECT_MIN_DELAY, doubling each time up to
+# WS_RECONNECT_MAX_DELAY, with some randomness so devices don't all reconnect
+# to the portal at once.
+WS_CONNECT_TIMEOUT = 10 * 1000
+WS_RECONNECT_MIN_DELAY = 2 * 1000
+WS_RECONNECT_MAX_DELAY = 60 * 1000
+
+# milliseconds between websocket keepalive pings, and to wait for each pong
+# before deciding the connection is dead and reconnecting
+WS_PING_INTERVAL = 5 * 1000
+WS_PING_TIMEOUT = 5 * 1000
+
+# packets to queue for the portal before the least important are dropped
+OUTBOX_SIZE = 32
+
+# milliseconds per main loop pass to spend sending queued packets
+OUTBOX_DRAIN_BUDGET = 20
@@ -21,3 +21,5 @@ VEND_PRICE = 250  # price in cents to debit an account
 # None, "hold" or "toggle" - None disable, hold until the accept coins signal is ready, toggle will hold for VEND_TOGGLE_TIME (s)
 VEND_MODE = "hold"
 VEND_TOGGLE_TIME = 1
+# seconds to wait for the accept coins signal to go low before refunding
+VEND_TIMEOUT = 60
@@ -0,0 +1,89 @@
+"""
+doorlock.py - door lock state machine
+
+Unlocking used to sleep for the whole unlock time when there's no door
+sensor, which stopped the main loop (and the websocket, and the WDT feeds)
+with it. DoorLock keeps track of when to relock instead, and a scheduler
+task calls update() to move it along:
+
+    LOCKED -> UNLOCKED -> RELOCK_PENDING -> LOCKED
+
+- UNLOCKED: waiting for the door to open. It locks again if the door isn't
+  opened within open_timeout_ms, or after unlock_ms without a door sensor.
+- RELOCK_PENDING: the door's been opened, so it locks relock_delay_ms later.
+
+Unlocking again while it's unlocked (e.g. a bump during a swipe) starts the
+wait again.
+"""
+
+import time
+
+LOCKED = "locked"
+UNLOCKED = "unlocked"
+RELOCK_PENDING = "relock_pending"
+
+
+class DoorLock:
+    def __init__(
+        self,
+        on_unlock,
+        on_lock,
+        door_open=None,
+        unlock_ms=7000,
+        open_timeout_ms=5000,
+        relock_delay_ms=500,
+    ):
+        """
+        on_unlock       - called to unlock the door
+        on_lock         - called to lock the door
+        door_open       - returns True while the door sensor says it's open,
+                          or None if there's no door sensor
+        unlock_ms       - how long to stay unlocked without a door sensor
+        open_timeout_ms - how long to wait for the door to open
+        relock_delay_ms - how long to wait to lock after the door opens
+        """
+        self._on_unlock = on_unlock
+        self._on_lock = on_lock
+        self._door_open = door_open
+        self.unlock_ms = unlock_ms
+        self.open_timeout_ms = open_timeout_ms
+        self.relock_delay_ms = relock_delay_ms
+
+        self.state = LOCKED
+        self._deadline = None  # ticks_ms to lock at
+
+    def unlock(self):
+        """Unlock the door, it's locked again by update()."""
+        if self._door_open is None:
+            wait_ms = self.unlock_ms
+        else:
+            wait_ms = self.open_timeout_ms
+        self._deadline = time.ticks_add(time.ticks_ms(), wait_ms)
+        self.state = UNLOCKED
+        self._on_unlock()
+
+    def lock(self):
+        """Lock the door now."""
+        self._deadline = None
+        self.state = LOCKED
+        self._on_lock()
+
+    def update(self):
+        """
+        Lock the door if it's time. Returns the reason it was locked, or None
+        if it wasn't.
+        """
+        if self.state == LOCKED:
+            return None
+
+        now = time.ticks_ms()
+        if self.state == UNLOCKED and self._door_open and self._door_open():
+            self._deadline = time.ticks_add(now, self.relock_delay_ms)
+            self.state = RELOCK_PENDING
+
+        if time.ticks_diff(now, self._deadline) < 0:
+            return None
+
+        reason = "opened" if self.state == RELOCK_PENDING else "timeout"
+        self.lock()
+        return reason
@@ -13,8 +13,8 @@ wdt = None
 
 if config.ENABLE_WDT:
     logger.warn("Press CTRL+C to stop the WDT starting...")
-    time.sleep(3)
-    wdt = WDT(timeout=config.FIXED_UNLOCK_DELAY * 2000 + 5000)
+    time.sleep(config.WDT_START_DELAY)
+    wdt = WDT(timeout=config.WDT_TIMEOUT * 1000)
 
 
 def feedWDT():
@@ -210,51 +210,123 @@ def buzzer_off():
             buzzer.off()
 
 
-def alert(rgb_return_colour=RGB_BLUE):
-    buzzer_on()
-    led_on()
-    rgb_led_set(RGB_RED)
-    time.sleep(0.3)
+# Feedback (beeps and flashes) is played from tables of steps by
+# update_feedback(), which the main loop calls, so a beep never holds up a
+# swipe or the network. Each step is (buzzer, reader LED, RGB colour,
+# milliseconds). The buzzer and LED are True or False, or None to leave them
+# as they are. The colour is an RGB_ colour, None to leave it, or RGB_RETURN
+# for the colour passed to play_feedback(). The last step is left in place.
+RGB_RETURN = "return"
+
+FEEDBACK_ALERT = (
+    (True, True, RGB_RED, 300),
+    (False, False, RGB_RETURN, 300),
+    (True, True, RGB_RED, 300),
+    (False, False, RGB_RETURN, 0),
+)
+FEEDBACK_OK = (
+    (True, True, RGB_GREEN, 1000),
+    (False, False, RGB_BLUE, 0),
+)
+FEEDBACK_OK_BUZZ = (
+    (True, None, None, 1000),
+    (False, None, None, 0),
+)
+FEEDBACK_CARD_READ = (
+    (True, None, None, 200),
+    (False, None, None, 0),
+)
+FEEDBACK_DECLINED = (
+    (None, True, RGB_RED, 250),
+    (None, False, None, 250),
+    (None, True, None, 250),
+    (None, False, RGB_RETURN, 0),
+)
+FEEDBACK_ACTION = (
+    (True, None, None, int(config.ACTION_BUZZ_DELAY * 1000)),
+    (False, None, None, 0),
+)
+
+_feedback = None  # the pattern playing
+_feedback_step = 0
+_feedback_step_end = None  # ticks_ms to move on to the next step
+_feedback_return_colour = RGB_BLUE
+
+
+def _apply_feedback_step(step):
+    buzz, led, colour, _ = step
+    if buzz is not None:
+        if buzz:
+            buzzer_on()
+        else:
+            buzzer_off()
+    if led is not None:
+        if led:
+            led_on()
+        else:
+            led_off()
+    if colour is not None:
+        rgb_led_set(_feedback_return_colour if colour is RGB_RETURN else colour)
 
-    buzzer_off()
-    led_off()
-    rgb_led_set(rgb_return_colour)
-    time.sleep(0.3)
 
-    buzzer_on()
-    led_on()
-    rgb_led_set(RGB_RED)
-    time.sleep(0.3)
+def _start_feedback_step(index, start):
+    global _feedback, _feedback_step, _feedback_step_end
 
-    buzzer_off()
-    led_off()
-    rgb_led_set(rgb_return_colour)
+    step = _feedback[index]
+    _apply_feedback_step(step)
+    if index == len(_feedback) - 1:
+        _feedback = None
+    else:
+        _feedback_step = index
+        _feedback_step_end = time.ticks_add(start, step[3])
 
 
-def buzz_ok(flash_led=True):
-    buzzer_on()
-    if flash_led:
-        led_on()
-        rgb_led_set(RGB_GREEN)
+def play_feedback(pattern, rgb_return_colour=RGB_BLUE):
+    """
+    Start playing a feedback pattern and return straight away. A pattern
+    that's already playing is cut short, leaving its last step in place.
+    """
+    global _feedback, _feedback_return_colour
+
+    if _feedback is not None:
+        _apply_feedback_step(_feedback[-1])
+    _feedback = pattern
+    _feedback_return_colour = rgb_return_colour
+    _start_feedback_step(0, time.ticks_ms())
+
+
+def update_feedback():
+    """Move the playing feedback pattern along. Call it often."""
+    now = time.ticks_ms()
+    while _feedback is not None and time.ticks_diff(now, _feedback_step_end) >= 0:
+        _start_feedback_step(_feedback_step + 1, _feedback_step_end)
 
-    time.sleep(1)
 
-    if flash_led:
-        led_off()
-        rgb_led_set(RGB_BLUE)
-    buzzer_off()
+def finish_feedback():
+    """
+    Wait for the playing feedback pattern to finish, feeding the WDT, for
+    when the main loop isn't running to play it (e.g. before a reset).
+    """
+    while _feedback is not None:
+        update_feedback()
+        feedWDT()
+        time.sleep_ms(10)
+
+
+def alert(rgb_return_colour=RGB_BLUE):
+    play_feedback(FEEDBACK_ALERT, rgb_return_colour)
+
+
+def buzz_ok(flash_led=True):
+    play_feedback(FEEDBACK_OK if flash_led else FEEDBACK_OK_BUZZ)
 
 
 def buzz_card_read():
-    buzzer_on()
-    time.sleep(0.2)
-    buzzer_off()
+    play_feedback(FEEDBACK_CARD_READ)
 
 
 def buzz_action():
-    buzzer_on()
-    time.sleep(config.ACTION_BUZZ_DELAY)
-    buzzer_off()
+    play_feedback(FEEDBACK_ACTION)
 
 
 def interlock_session_started():
@@ -368,35 +440,12 @@ def get_aux_2_state():
         return aux_2_pin.value()
 
 
-def vend_product():
-    rgb_led_set(RGB_GREEN)
-    led_on()
-    if config.BUZZ_ON_SWIPE:
-        buzz_action()
-
-    if config.VEND_MODE == "toggle":
-        # TODO: timeout after 60 seconds and refund the money
-        # currently we will wait forever for the accept coins signal to go low
-        # even if a drink is never vended.
-        relay_on()
-        unlock()
-        start_time = time.time()
-        while time.time() - start_time < config.VEND_TOGGLE_TIME:
-            time.sleep(0.1)
-            feedWDT()
-        relay_off()
-        lock()
-    elif config.VEND_MODE == "hold":
-        relay_on()
-        unlock()
-        time.sleep(1)
-
-        # once the vend relay is on, we need to wait for the accept coins (door sensor)
-        # signal to go low before we can turn it off again
-        while get_in_1_state():
-            time.sleep(0.1)
-        relay_off()
-        lock()
+def vend_start():
+    """Turn the vend relay on, vend.Vend stops it with vend_stop()."""
+    relay_on()
+    unlock()  # green and the reader LED on
 
-    rgb_led_set(RGB_BLUE)
-    led_off()
+
+def vend_stop():
+    relay_off()
+    lock()  # back to blue and the reader LED off
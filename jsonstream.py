@@ -0,0 +1,254 @@
+"""
+jsonstream.py - incremental decoder for large JSON packets
+
+json.loads() builds the whole packet in RAM at once, so a large tag sync ends
+up holding the raw packet, a list with a string object for every tag and the
+old tags at the same time. This decoder walks the packet a chunk at a time.
+Elements of the arrays named in `streams` are handed to a callback one at a
+time instead of being stored, every other top-level field is decoded normally.
+The returned fields hold the number of elements streamed for those keys.
+
+Array elements that are non-negative integers, or strings of digits (how the
+portal sends card IDs), are passed to the callback as an int without creating
+a string. Anything else is decoded with json.loads() first.
+
+    decoder = StreamDecoder({"tags": new_tags.append})
+    decoder.feed(packet)
+    fields = decoder.close()
+"""
+
+import json
+
+# decoder states
+_START = 0  # waiting for the opening "{"
+_KEY_START = 1  # waiting for a key or the closing "}"
+_KEY = 2
+_COLON = 3
+_VALUE = 4  # waiting for the start of a value
+_RAW_VALUE = 5  # capturing a value to decode with json.loads
+_AFTER_VALUE = 6  # waiting for "," or "}"
+_ARRAY = 7  # inside a streamed array, waiting for an element, "," or "]"
+_ELEMENT_STRING = 8
+_ELEMENT_NUMBER = 9
+_ELEMENT_RAW = 10
+_DONE = 11
+
+_QUOTE = 0x22
+_BACKSLASH = 0x5C
+_COMMA = 0x2C
+_COLON_CHAR = 0x3A
+_OPEN_OBJECT = 0x7B
+_CLOSE_OBJECT = 0x7D
+_OPEN_ARRAY = 0x5B
+_CLOSE_ARRAY = 0x5D
+
+
+def _is_space(c):
+    return c == 0x20 or c == 0x0A or c == 0x0D or c == 0x09
+
+
+def _is_digit(c):
+    return 0x30 <= c <= 0x39
+
+
+def _digits_to_token(number, length):
+    # rebuild the digits we've already consumed, including any leading zeros
+    digits = str(number) if length else ""
+    return bytearray(("0" * (length - len(digits)) + digits).encode())
+
+
+class StreamDecoder:
+    def __init__(self, streams=None):
+        """
+        streams - a dict of top-level key: callback. Elements of an array
+                  under that key are passed to the callback one at a time.
+        """
+        self._streams = streams or {}
+        self._fields = {}
+        self._state = _START
+        self._key = None
+        self._callback = None
+        self._token = None
+        self._number = 0
+        self._length = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk):
+        """Decode the next chunk (bytes, bytearray, memoryview or str)."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+
+        state = self._state
+        token = self._token
+        number = self._number
+        length = self._length
+        depth = self._depth
+        in_string = self._in_string
+        escape = self._escape
+
+        for c in chunk:
+            # the hottest states (tag arrays) are checked first
+            if state == _ELEMENT_STRING:
+                if token is None:
+                    if _is_digit(c):
+                        number = number * 10 + c - 0x30
+                        length += 1
+                        continue
+                    if c == _QUOTE:
+                        if length:
+                            self._callback(number)
+                        else:
+                            self._callback("")
+                        state = _ARRAY
+                        continue
+                    token = _digits_to_token(number, length)
+
+                if escape:
+                    escape = False
+                elif c == _BACKSLASH:
+                    escape = True
+                elif c == _QUOTE:
+                    self._callback(json.loads(b'"' + token + b'"'))
+                    token = None
+                    state = _ARRAY
+                    continue
+                token.append(c)
+
+            elif state == _ARRAY:
+                if _is_space(c) or c == _COMMA:
+                    continue
+                elif c == _CLOSE_ARRAY:
+                    state = _AFTER_VALUE
+                    continue
+                self._fields[self._key] += 1
+
+                if c == _QUOTE:
+                    number = length = 0
+                    state = _ELEMENT_STRING
+                elif _is_digit(c):
+                    number = c - 0x30
+                    length = 1
+                    state = _ELEMENT_NUMBER
+                else:
+                    token = bytearray()
+                    token.append(c)
+                    depth = 1 if c == _OPEN_OBJECT or c == _OPEN_ARRAY else 0
+                    in_string = c == _QUOTE
+                    state = _ELEMENT_RAW
+
+            elif state == _ELEMENT_NUMBER:
+                if c == _COMMA or c == _CLOSE_ARRAY or _is_space(c):
+                    if token is None:
+                        self._callback(number)
+                    else:
+                        self._callback(json.loads(token))
+                        token = None
+                    state = _AFTER_VALUE if c == _CLOSE_ARRAY else _ARRAY
+                elif token is None and _is_digit(c):
+                    number = number * 10 + c - 0x30
+                    length += 1
+                else:
+                    if token is None:
+                        token = _digits_to_token(number, length)
+                    token.append(c)
+
+            elif state == _RAW_VALUE or state == _ELEMENT_RAW:
+                if in_string:
+                    if escape:
+                        escape = False
+                    elif c == _BACKSLASH:
+                        escape = True
+                    elif c == _QUOTE:
+                        in_string = False
+                elif c == _QUOTE:
+                    in_string = True
+                elif c == _OPEN_OBJECT or c == _OPEN_ARRAY:
+                    depth += 1
+                elif depth and (c == _CLOSE_OBJECT or c == _CLOSE_ARRAY):
+                    depth -= 1
+                elif not depth and (
+                    c == _COMMA or c == _CLOSE_OBJECT or c == _CLOSE_ARRAY
+                ):
+                    value = json.loads(token)
+                    token = None
+
+                    if state == _ELEMENT_RAW:
+                        self._callback(value)
+                        state = _AFTER_VALUE if c == _CLOSE_ARRAY else _ARRAY
+                        continue
+
+                    self._fields[self._key] = value
+                    if c == _COMMA:
+                        state = _KEY_START
+                    elif c == _CLOSE_OBJECT:
+                        state = _DONE
+                    else:
+                        raise ValueError("Unexpected ] in JSON packet")
+                    continue
+                token.append(c)
+
+            elif state == _KEY:
+                if escape:
+                    escape = False
+                elif c == _BACKSLASH:
+                    escape = True
+                elif c == _QUOTE:
+                    self._key = json.loads(b'"' + token + b'"')
+                    token = None
+                    state = _COLON
+                    continue
+                token.append(c)
+
+            elif _is_space(c):
+                continue
+
+            elif state == _VALUE:
+                self._callback = self._streams.get(self._key)
+                if self._callback and c == _OPEN_ARRAY:
+                    self._fields[self._key] = 0
+                    state = _ARRAY
+                else:
+                    token = bytearray()
+                    token.append(c)
+                    depth = 1 if c == _OPEN_OBJECT or c == _OPEN_ARRAY else 0
+                    in_string = c == _QUOTE
+                    state = _RAW_VALUE
+
+            elif state == _KEY_START and c == _QUOTE:
+                token = bytearray()
+                state = _KEY
+            elif state == _COLON and c == _COLON_CHAR:
+                state = _VALUE
+            elif state == _AFTER_VALUE and c == _COMMA:
+                state = _KEY_START
+            elif (state == _AFTER_VALUE or state == _KEY_START) and (
+                c == _CLOSE_OBJECT
+            ):
+                state = _DONE
+            elif state == _START and c == _OPEN_OBJECT:
+                state = _KEY_START
+            else:
+                raise ValueError("Unexpected character in JSON packet: " + chr(c))
+
+        self._state = state
+        self._token = token
+        self._number = number
+        self._length = length
+        self._depth = depth
+        self._in_string = in_string
+        self._escape = escape
+
+    def close(self):
+        """Finish decoding and return a dict of the fields that weren't streamed."""
+        if self._state != _DONE:
+            raise ValueError("Incomplete JSON packet")
+        return self._fields
+
+
+def loads(data, streams=None):
+    """Decode a complete JSON packet, streaming the arrays named in streams."""
+    decoder = StreamDecoder(streams)
+    decoder.feed(data)
+    return decoder.close()
@@ -5,9 +5,18 @@ import time, utime
 from machine import reset
 import ubinascii
 import json
-import uwebsockets.client
+import uwebsockets.connector
 import hardware
 import utils
+import tagstore
+import storage
+import jsonstream
+import cbor
+import outbox
+import doorlock
+import vend
+import scheduler
+import packets
 import gc
 
 if config.ENABLE_BACKUP_HTTP_SERVER:
@@ -23,19 +32,37 @@ hardware.led_off()
 # setup is starting
 hardware.rgb_led_set(hardware.RGB_PURPLE)
 hardware.alert(rgb_return_colour=hardware.RGB_PURPLE)
+hardware.finish_feedback()  # the main loop isn't running to play it yet
 hardware.lcd.print("Initialising...")
 
 
 INTERLOCK_SESSION = {
     "session_id": None,  # any value == on, None == off
     "session_kwh": 0,
+    "card_id": None,  # the card that started the session
 }
-STATE = {"locked_out": False, "tag_hash": ""}
-authorised_rfid_tags = []
+STATE = storage.JsonStore("state.json", {"locked_out": False})
+authorised_rfid_tags = tagstore.FlashTagStore("tags.bin")
+OUTBOX = outbox.Outbox(
+    config.OUTBOX_SIZE, packets.encode_json
+)  # packets waiting to go to the portal
+
+# MMADP authorisation tiers (see PROTOCOL.md)
+tier_tags = {
+    "online": tagstore.FlashTagStore("tags_online.bin"),
+    "offline": tagstore.FlashTagStore("tags_offline.bin"),
+    "admin": tagstore.FlashTagStore("tags_admin.bin"),
+}
+tier_tags_incoming = {}  # tier: (TagStore, next chunk number) while receiving chunks
+
+ACCESS_GRANTED = "granted"
+ACCESS_DENIED = "denied"
+ACCESS_LOCKED_OUT = "locked_out"
 
 sta_if = network.WLAN(network.STA_IF)
 local_ip = None  # store our local IP address
 local_mac = ubinascii.hexlify(sta_if.config("mac")).decode()  # store our mac address
+
 hostname = "BeepBeep_" + local_mac
 
 logger.info("Setting hostname to: " + hostname)
@@ -43,14 +70,27 @@ network.hostname(hostname)
 logger.info("Setting WiFi country code to: " + config.WIFI_COUNTRY_CODE)
 network.country(config.WIFI_COUNTRY_CODE)
 
+WS_URL = f"{config.PORTAL_WS_URL}/{config.DEVICE_TYPE}/{local_mac}"
+logger.debug("WS_URL: " + WS_URL)
+websocket_connector = uwebsockets.connector.Connector(
+    WS_URL,
+    max_message_size=config.WS_MAX_MESSAGE_SIZE,
+    deflate_wbits=config.WS_DEFLATE_WINDOW_BITS,
+    timeout_ms=config.WS_CONNECT_TIMEOUT,
+    min_backoff_ms=config.WS_RECONNECT_MIN_DELAY,
+    max_backoff_ms=config.WS_RECONNECT_MAX_DELAY,
+)
+
 last_card_id = None
 websocket = None
-led_update = time.ticks_ms()
-ten_second_cron_update = time.ticks_ms()
-last_pong = None
 last_rfid_sync = time.ticks_ms()
-waiting_for_door_open_time = None
 door_opened_time = None
+first_unlock_logged = False
+packet_decoder = None  # decodes a websocket packet as its frames arrive
+packet_tag_stores = None
+debit_card_id = None  # the card waiting for a debit response
+debit_sent_time = None
+standby_message_task = None
 
 
 # setup RFID
@@ -69,34 +109,15 @@ else:
 
     rfid_reader = Rdm6300(rx=config.UART_RX_PIN, tx=config.UART_TX_PIN)
 
-try:
-    # create it if it doesn't exist
-    if not utils.file_or_dir_exists("tags.json"):
-        with open("tags.json", "w") as new_tags:
-            json.dump([], new_tags)
-
-        # if we have any saved tags, load them
-    with open("tags.json") as tags:
-        parsed_tags = json.load(tags)
-        if parsed_tags:
-            authorised_rfid_tags = parsed_tags
-            logger.info("Loaded %s saved tags from flash.", len(authorised_rfid_tags))
-except Exception as e:
-    logger.error("Could not load saved tags (unhandled error)")
-    logger.error(e)
-
-
-def save_state(state):
-    global STATE
-    logger.info("Saving STATE!!")
-
-    STATE = state  # update the in memory state
 
+def save_state(delay_ms=0):
+    """
+    Write STATE to flash if it has changed. With a delay, a burst of changes
+    is batched into a single write once they've settled.
+    """
     try:
-        # save the state to flash
-        with open("state.json", "w") as state_file:
-            json.dump(state, state_file)
-            logger.debug("saved state to flash")
+        if STATE.flush(delay_ms):
+            logger.info("Saved STATE to flash.")
         return True
 
     except Exception as e:
@@ -106,18 +127,11 @@ def save_state(state):
 
 
 def get_state():
-    global STATE
     try:
-        # create it if it doesn't exist
-        if not utils.file_or_dir_exists("state.json"):
-            with open("state.json", "w") as state_file:
-                json.dump(STATE, state_file)
-
-        with open("state.json") as state_file:
-            STATE = json.load(state_file)
-            if STATE:
-                logger.info("Loaded saved STATE from flash.")
-            return STATE
+        # creates it from the defaults if it doesn't exist
+        if STATE.load():
+            logger.info("Loaded saved STATE from flash.")
+        return STATE
 
     except Exception as e:
         logger.error("Could not load saved STATE (unhandled error)")
@@ -136,8 +150,10 @@ def connect_wifi(silent=False):
         sta_if.disconnect()
         time.sleep(0.5)
 
-    sta_if.active(False)
-    time.sleep(0.5)
+    # no need to reset the radio if it's not on yet (i.e. on boot)
+    if sta_if.active():
+        sta_if.active(False)
+        time.sleep(0.5)
     sta_if.active(True)
     # sta_if.config(pm=sta_if.PM_NONE)  # disable power management
     # sta_if.config(reconnects=-1)
@@ -203,28 +219,49 @@ def connect_wifi(silent=False):
 
 
 def connect_websocket():
-    global websocket, last_pong
-
-    if not sta_if.isconnected():
-        logger.warn("Tried to setup websocket but WiFi is not connected...")
-        connect_wifi(silent=True)
+    """
+    Move the websocket connection along without holding up the main loop, and
+    log in to the portal once it's open. Failed attempts are retried after a
+    jittered, exponential backoff.
+    """
+    global websocket, local_ip, packet_decoder
+
+    was_connecting = websocket_connector.connecting
+    try:
+        new_websocket = websocket_connector.poll()
+    except Exception as e:
+        logger.error("Couldn't connect to websocket!")
+        logger.error(e)
+        hardware.lcd.clear()
+        hardware.lcd.print("WS Connect Fail")
+        hardware.status_led_off()
         return
 
-    WS_URL = f"{config.PORTAL_WS_URL}/{config.DEVICE_TYPE}/{local_mac}"
-
-    try:
+    if websocket_connector.connecting and not was_connecting:
         logger.info("Connecting to websocket...")
-        logger.debug("WS_URL: " + WS_URL)
         hardware.status_led_off()
         hardware.lcd.clear()
         hardware.lcd.print("Connecting WS")
-        websocket = uwebsockets.client.connect(WS_URL)
-        last_pong = time.ticks_ms()
 
+    if not new_websocket:
+        return
+
+    websocket = new_websocket
+    # websocket pings detect a dead link, and the RTT goes in our JSON pings
+    websocket.keepalive(config.WS_PING_INTERVAL, config.WS_PING_TIMEOUT)
+    local_ip = sta_if.ifconfig()[0]
+    packet_decoder = None  # drop any packet half received before
+    OUTBOX.encode = packets.encode_json  # until the portal accepts CBOR
+
+    try:
         auth_packet = {
             "command": "authenticate",
             "secret_key": config.API_SECRET,
+            "tag_hash": authorised_rfid_tags.tag_hash,
+            "sync_delta": True,  # we support incremental "sync_delta" packets
         }
+        if config.WS_CBOR_ENCODING:
+            auth_packet["encodings"] = ["cbor", "json"]
         websocket.send(json.dumps(auth_packet))
 
         ip_packet = {"command": "ip_address", "ip_address": local_ip}
@@ -232,56 +269,223 @@ def connect_websocket():
         hardware.status_led_on()
 
     except Exception as e:
-        logger.error("Couldn't connect to websocket!")
+        drop_websocket()
+        logger.error("Couldn't log in to the portal!")
         logger.error(e)
-        hardware.lcd.clear()
-        hardware.lcd.print("WS Connect Fail")
         hardware.status_led_off()
 
 
-def save_tags(new_tags):
-    global authorised_rfid_tags
+def load_tags():
+    try:
+        # one-time migration from the old tags.json format
+        if not utils.file_or_dir_exists("tags.bin") and utils.file_or_dir_exists(
+            "tags.json"
+        ):
+            logger.info("Migrating tags.json to tags.bin")
+            # older firmware kept the tag hash in state.json
+            tagstore.migrate_json(
+                "tags.json", authorised_rfid_tags, STATE.get("tag_hash")
+            )
+
+        # only the headers are read here, load_tags_step() builds the indexes
+        if authorised_rfid_tags.open(background=True):
+            logger.info("Opened %s saved tags on flash.", len(authorised_rfid_tags))
+
+        for tier, store in tier_tags.items():
+            if store.open(background=True):
+                logger.info("Opened %s saved %s tags on flash.", len(store), tier)
+
+    except Exception as e:
+        logger.error("Could not load saved tags (unhandled error)")
+        logger.error(e)
+
+
+def load_tags_step():
+    """
+    Build the tag indexes a few pages at a time, so swipes are serviced while
+    the tags load. Returns True once every store is loaded.
+    """
+    done = authorised_rfid_tags.load()
+    for store in tier_tags.values():
+        done = store.load() and done
+
+    if done:
+        logger.info(f"Finished loading tags {time.ticks_ms()} ms after power on.")
+    return done
+
+
+def save_tags(new_tags, tag_hash):
     logger.info("Syncing tags!!")
 
     try:
-        authorised_rfid_tags = new_tags
-        logger.info("Got %s tags!", len(authorised_rfid_tags))
+        logger.info("Got %s tags!", len(new_tags))
         # save the tags to flash
-        with open("tags.json", "w") as tags_file:
-            json.dump(authorised_rfid_tags, tags_file)
-            logger.debug("Saved tags to flash")
-
+        authorised_rfid_tags.replace(new_tags, tag_hash)
         logger.debug("Syncing tags done!")
+        return True
 
     except Exception as e:
         logger.error("Syncing tags FAILED! Exception:")
         logger.error(str(e))
+        return False
+
+
+def save_tier_tags(tier, ids, tag_hash, chunk=None, chunks=None):
+    """
+    Handle an id_authorised_<tier> packet. Long lists are sent in chunks of
+    up to 350 IDs, which are collected in RAM and saved to flash once the
+    last chunk arrives.
+    """
+    if chunk is None:
+        chunk, chunks = 0, 1
+
+    if not (isinstance(chunk, int) and isinstance(chunks, int) and 0 <= chunk < chunks):
+        logger.warn(f"Got {tier} tags chunk {chunk} of {chunks}, ignoring it!")
+        tier_tags_incoming.clear()  # the lists start again after the full sync
+        request_full_sync()
+        return False
+
+    if chunk == 0:
+        incoming, next_chunk = tagstore.TagStore(), 0
+    else:
+        incoming, next_chunk = tier_tags_incoming.pop(tier, (None, None))
+
+    if chunk != next_chunk:
+        logger.warn(f"Got {tier} tags chunk {chunk} but expected {next_chunk}!")
+        request_full_sync()
+        return False
+
+    for card_id in ids or ():
+        incoming.append(card_id)
+
+    if chunk + 1 < chunks:
+        tier_tags_incoming[tier] = (incoming, chunk + 1)
+        return True
+
+    try:
+        incoming.finish()
+        tier_tags[tier].replace(incoming, tag_hash)
+        logger.info("Saved %s %s tags.", len(incoming), tier)
+        return True
+
+    except Exception as e:
+        logger.error(f"Saving {tier} tags FAILED! Exception:")
+        logger.error(str(e))
+        return False
+
+
+def drop_websocket():
+    """Close the websocket, freeing its socket and buffers, so it reconnects."""
+    global websocket
+
+    if websocket is not None:
+        try:
+            websocket.close()
+        except OSError:
+            pass  # the link's already gone
+    websocket = None
+
+
+def send_packet(packet, priority=outbox.PRIORITY_NORMAL):
+    """
+    Queue a packet for the main loop to send to the portal, so a slow write
+    doesn't hold up the caller. Raises OSError if we're not connected.
+    """
+    if not (websocket and websocket.open):
+        raise OSError("Websocket not connected")
+    OUTBOX.put(packet, priority)
+
+
+def send_queued_packets(budget_ms=None):
+    """Send queued packets until they're all sent or the time budget runs out."""
+    if not (websocket and websocket.open):
+        return
+    try:
+        OUTBOX.drain(websocket, budget_ms or config.OUTBOX_DRAIN_BUDGET)
+    except Exception as e:
+        drop_websocket()
+        logger.error("Websocket not open, trying to reconnect.")
+        logger.error(e)
+        hardware.status_led_off()
+
+
+def request_full_sync():
+    logger.info("Requesting a full tag sync.")
+    try:
+        send_packet({"command": "sync_request", "hash": authorised_rfid_tags.tag_hash})
+    except Exception as e:
+        logger.error("Failed to request a full tag sync!")
+        logger.error(e)
+
+
+def save_tags_delta(base_hash, new_hash, added, removed):
+    """
+    Apply a "sync_delta" packet. Deltas are chained by hash, so they're only
+    applied on top of the exact tag set they were generated against. If our
+    hash doesn't match the base we've missed something and need a full sync.
+    """
+    tags_hash_current = authorised_rfid_tags.tag_hash
+
+    if new_hash == tags_hash_current:
+        logger.info("Tags hash unchanged, skipping delta.")
+        return True
+
+    if base_hash != tags_hash_current:
+        logger.warn(
+            f"Tag delta base {base_hash} doesn't match our hash {tags_hash_current}!"
+        )
+        request_full_sync()
+        return False
+
+    try:
+        changed = authorised_rfid_tags.apply_delta(added or (), removed or (), new_hash)
+        logger.info(
+            "Applied tag delta (%s changed), now %s tags.",
+            changed,
+            len(authorised_rfid_tags),
+        )
+
+    except Exception as e:
+        logger.error("Applying tag delta FAILED! Exception:")
+        logger.error(str(e))
+        request_full_sync()
+        return False
+
+    return True
 
 
-def log_door_swipe(card_id, rejected=False, locked_out=False):
+def card_id_to_json(card_id):
+    # card IDs are ints on the device, but the portal expects strings
+    return None if card_id is None else str(card_id)
+
+
+def log_door_swipe(card_id: int, rejected=False, locked_out=False):
     success_string = "failed" if rejected or locked_out else "successful"
     logger.info(f"Logging {success_string} door swipe!")
+    card_id = card_id_to_json(card_id)
 
     if websocket:
         try:
             if rejected:
-                websocket.send(
-                    json.dumps({"command": "log_access_denied", "card_id": card_id})
-                )
+                template = packets.LOG_ACCESS_DENIED
             elif locked_out:
-                websocket.send(
-                    json.dumps({"command": "log_access_locked_out", "card_id": card_id})
-                )
+                template = packets.LOG_ACCESS_LOCKED_OUT
             else:
-                websocket.send(
-                    json.dumps({"command": "log_access", "card_id": card_id})
-                )
+                template = packets.LOG_ACCESS
+            send_packet(template(card_id), outbox.PRIORITY_HIGH)
         except Exception as e:
             logger.warn(f"Exception when logging {success_string} access!")
             logger.error(e)
 
 
-def interlock_end_session():
+def interlock_end_session(card=None):
+    """
+    End the interlock session. card is the card that ended it, or None to log
+    it against the card that started it (e.g. the portal ended it).
+    """
+    if card is None:
+        card = INTERLOCK_SESSION.get("card_id")
+
     if (
         INTERLOCK_SESSION.get("session_id")
         and INTERLOCK_SESSION.get("session_id") != "system"
@@ -292,9 +496,9 @@ def interlock_end_session():
                 "command": "interlock_session_end",
                 "session_id": INTERLOCK_SESSION.get("session_id"),
                 "session_kwh": INTERLOCK_SESSION.get("session_kwh"),
-                "card_id": card,
+                "card_id": card_id_to_json(card),
             }
-            websocket.send(json.dumps(interlock_packet))
+            send_packet(interlock_packet, outbox.PRIORITY_HIGH)
         except Exception as e:
             hardware.alert()
             logger.error("Failed to end interlock session!")
@@ -302,37 +506,59 @@ def interlock_end_session():
 
     INTERLOCK_SESSION["session_id"] = None
     INTERLOCK_SESSION["session_kwh"] = 0
+    INTERLOCK_SESSION["card_id"] = None
     hardware.interlock_power_control(False)
     hardware.interlock_session_ended()
 
 
-def handle_swipe_door(card: str):
-    global authorised_rfid_tags
+def check_card_access(card):
+    """
+    Decide if a card may unlock the device, with at most one lookup per tier.
+    Admin tags are always allowed, even offline or when locked out. Other tags
+    are allowed from the synced tags and the online or offline tier depending
+    on whether we're connected to the portal.
+    """
+    if card in tier_tags["admin"]:
+        return ACCESS_GRANTED
+
+    online = websocket is not None and websocket.open
+    if (
+        card in authorised_rfid_tags
+        or card in tier_tags["online" if online else "offline"]
+    ):
+        return ACCESS_LOCKED_OUT if STATE["locked_out"] else ACCESS_GRANTED
+
+    return ACCESS_DENIED
+
+
+def handle_swipe_door(card: int):
     hardware.buzz_card_read()
 
-    if card in authorised_rfid_tags:
-        if STATE["locked_out"]:
-            log_door_swipe(card, locked_out=True)
-            hardware.alert()
+    access = check_card_access(card)
 
-        else:
-            log_door_swipe(card)
-            unlock_door()
+    if access == ACCESS_GRANTED:
+        log_door_swipe(card)
+        unlock_door()
+
+    elif access == ACCESS_LOCKED_OUT:
+        log_door_swipe(card, locked_out=True)
+        hardware.alert()
 
     else:
         log_door_swipe(card, rejected=True)
         hardware.alert()
 
 
-def handle_swipe_interlock(card: str):
+def handle_swipe_interlock(card: int):
     # request a new interlock session
     if INTERLOCK_SESSION.get("session_id") is None:
+        INTERLOCK_SESSION["card_id"] = card
         interlock_packet = {
             "command": "interlock_session_start",
-            "card_id": card,
+            "card_id": card_id_to_json(card),
         }
         try:
-            websocket.send(json.dumps(interlock_packet))
+            send_packet(interlock_packet, outbox.PRIORITY_HIGH)
         except Exception as e:
             logger.error("Failed to start interlock session!")
             logger.error(e)
@@ -343,8 +569,8 @@ def handle_swipe_interlock(card: str):
         interlock_packet = {"command": "interlock_off"}
 
         try:
-            websocket.send(json.dumps(interlock_packet))
-            interlock_end_session()
+            send_packet(interlock_packet, outbox.PRIORITY_HIGH)
+            interlock_end_session(card)
         except Exception as e:
             logger.error("Failed to turn off interlock!")
             logger.error(e)
@@ -352,18 +578,39 @@ def handle_swipe_interlock(card: str):
 
     # end the current interlock session
     else:
-        interlock_end_session()
+        interlock_end_session(card)
 
 
-def handle_swipe_memberbucks(card_id: str):
+def debit_pending():
+    """True while a debit is waiting for the portal's response."""
+    return debit_card_id is not None and (
+        time.ticks_diff(time.ticks_ms(), debit_sent_time)
+        < config.DEBIT_RESPONSE_TIMEOUT * 1000
+    )
+
+
+def handle_swipe_memberbucks(card_id: int):
+    global debit_card_id, debit_sent_time
+
+    if VEND.busy:
+        # don't take another payment until the machine's free
+        logger.info("Vend in progress, ignoring the swipe.")
+        hardware.alert(rgb_return_colour=hardware.RGB_GREEN)
+        return
+
+    if debit_pending():
+        # the response is matched to the card that's waiting for it
+        logger.info("Debit in progress, ignoring the swipe.")
+        hardware.alert()
+        return
+
     # attempt to debit the card
-    debit_packet = {
-        "command": "debit",
-        "card_id": card_id,
-        "amount": config.VEND_PRICE / 100,
-    }
+    cancel_standby_message()
+    debit_packet = packets.DEBIT(card_id_to_json(card_id), config.VEND_PRICE / 100)
     try:
-        websocket.send(json.dumps(debit_packet))
+        send_packet(debit_packet, outbox.PRIORITY_HIGH)
+        debit_card_id = card_id
+        debit_sent_time = time.ticks_ms()
         hardware.lcd.clear()
         hardware.lcd.print("Please Wait... ")
         hardware.lcd.blink()
@@ -373,6 +620,51 @@ def handle_swipe_memberbucks(card_id: str):
         hardware.alert()
 
 
+def decode_packet(packet, final=True):
+    """
+    Decode a websocket packet (a str or a memoryview of the receive buffer),
+    in JSON or CBOR. A packet split into several websocket frames can be fed
+    in a frame at a time, with final=False until the last one. Returns None
+    until the packet is complete.
+
+    Tag arrays are streamed straight into TagStores so a large sync never
+    builds a list of tag strings, or the whole packet, in RAM.
+    """
+    global packet_decoder, packet_tag_stores
+
+    if packet_decoder is None:
+        if not (packet or final):
+            return None  # can't tell the encoding yet
+        packet_tag_stores = {
+            "tags": tagstore.TagStore(),
+            "add": tagstore.TagStore(),
+            "remove": tagstore.TagStore(),
+            "payload": tagstore.TagStore(),  # id_authorised_* packets
+        }
+        decoder = cbor if cbor.is_packet(packet) else jsonstream
+        packet_decoder = decoder.StreamDecoder(
+            {key: store.append for key, store in packet_tag_stores.items()}
+        )
+
+    try:
+        packet_decoder.feed(packet)
+        if not final:
+            return None
+        data = packet_decoder.close()
+    except Exception:
+        packet_decoder = None  # start afresh with the next packet
+        raise
+    packet_decoder = None
+
+    for key, store in packet_tag_stores.items():
+        if key in data:
+            store.finish()
+            data[key] = store
+
+    packet_tag_stores = None
+    return data
+
+
 def print_device_standby_message():
     if config.DEVICE_TYPE == "door":
         hardware.lcd.clear()
@@ -389,73 +681,224 @@ def print_device_standby_message():
             hardware.lcd.print(f"No Connection")
 
 
-def unlock_door():
-    global waiting_for_door_open_time
+def show_standby_message_later(delay_ms):
+    """Go back to the standby message after delay_ms, without blocking."""
+    global standby_message_task
+
+    cancel_standby_message()
+    standby_message_task = TASKS.after(delay_ms, print_device_standby_message)
+
+
+def cancel_standby_message():
+    global standby_message_task
+
+    TASKS.cancel(standby_message_task)
+    standby_message_task = None
+
+
+def on_door_unlocked():
+    global first_unlock_logged
 
     hardware.unlock()
     hardware.relay_on()
     logger.warn("Unlocked!")
+
+    if not first_unlock_logged:
+        first_unlock_logged = True
+        logger.warn(f"First unlock {time.ticks_ms()} ms after power on.")
     hardware.lcd.print("Door Unlocked!")
     hardware.rgb_led_set(hardware.RGB_GREEN)
     hardware.buzz_ok(flash_led=False)
 
     if config.DOOR_SENSOR_ENABLED:
-        waiting_for_door_open_time = time.ticks_ms()
         print_device_standby_message()
-    else:
-        time.sleep(config.FIXED_UNLOCK_DELAY)
-        lock_door()
-        hardware.relay_off()
-
 
-def lock_door():
-    global waiting_for_door_open_time
 
-    waiting_for_door_open_time = None
+def on_door_locked():
     hardware.lock()
     hardware.relay_off()
     logger.warn("Locked!")
     print_device_standby_message()
 
 
-get_state()  # grab the state from the flash
-connect_wifi()  # connect to wifi
-connect_websocket()  # connect to the websocket
+DOOR_LOCK = doorlock.DoorLock(
+    on_door_unlocked,
+    on_door_locked,
+    door_open=hardware.get_door_sensor_state if config.DOOR_SENSOR_ENABLED else None,
+    unlock_ms=config.FIXED_UNLOCK_DELAY * 1000,
+    open_timeout_ms=config.DOOR_SENSOR_TIMEOUT * 1000,
+)
 
-if config.ENABLE_BACKUP_HTTP_SERVER:
-    import uselect
 
-    logger.warning(
-        "The backup http server is enabled. This is not recommended for production use!"
-    )
+VEND = vend.Vend(
+    hardware.vend_start,
+    hardware.vend_stop,
+    accepting=hardware.get_in_1_state,
+    mode=config.VEND_MODE,
+    toggle_ms=config.VEND_TOGGLE_TIME * 1000,
+    timeout_ms=config.VEND_TIMEOUT * 1000,
+)
 
-    # try to set up the http server
-    if not httpserver.setup_http_server():
-        logger.error("FAILED to setup http server on startup :(")
-    else:
-        poll = uselect.poll()
-        poll.register(httpserver.sock, uselect.POLLIN)
-else:
-    logger.debug("Backup http server disabled!")
 
-logger.info("Starting main loop...")
-hardware.led_on()
-time.sleep(0.5)
-hardware.led_off()
-hardware.rgb_led_set(hardware.RGB_BLUE)
+def unlock_door():
+    """Unlock the door. The check_door task locks it again."""
+    DOOR_LOCK.unlock()
 
 
-print_device_standby_message()
+def lock_door():
+    """Lock the door now, cancelling any relock that's waiting."""
+    DOOR_LOCK.lock()
 
-door_previous_state = hardware.get_door_sensor_state()
-in_1_previous_state = hardware.get_in_1_state()
-wifi_status_led_toggle = False
-wifi_status_led_update = time.ticks_ms()
 
-hardware.out_1_on()
+def handle_packet(data):
+    """Act on a packet from the portal."""
+    global debit_card_id
+
+    if data.get("authorised") is not None:
+        logger.info("Got authorisation packet.")
+        if data.get("encoding") == "cbor":
+            logger.info("Sending packets to the portal as CBOR.")
+            OUTBOX.encode = packets.encode_cbor
+        print_device_standby_message()
+
+    elif data.get("command") == "pong":
+        pass  # liveness is checked with websocket pings
+
+    elif data.get("command") == "ping":
+        send_packet(packets.PONG())
+
+    elif data.get("command") == "reboot":
+        logger.warn("Rebooting device!")
+        if config.DEVICE_TYPE == "interlock":
+            interlock_end_session()
+        else:
+            hardware.lock()
+            hardware.buzz_action()
+        hardware.rgb_led_set(hardware.RGB_OFF)
+        save_state()
+        send_queued_packets(budget_ms=1000)  # e.g. the session end
+        hardware.finish_feedback()
+        reset()
+
+    elif data.get("command") == "update_device_locked_out":
+        locked_out = data.get("locked_out")
+        logger.info(f"Updating device locked out {locked_out}!")
+        STATE["locked_out"] = locked_out
+
+    elif data.get("command") == "bump" and config.DEVICE_TYPE == "door":
+        logger.info("Bumping Door!")
+        unlock_door()
+
+    elif data.get("command") == "sync":
+        tags_hash_new = data.get("hash")
+        tags_hash_current = authorised_rfid_tags.tag_hash
+
+        if tags_hash_new != tags_hash_current:
+            if save_tags(data.get("tags"), tags_hash_new):
+                logger.info(f"Saved tags with hash: {tags_hash_new}")
+        else:
+            logger.info("Tags hash unchanged, skipping save.")
+
+    elif data.get("command") in (
+        "id_authorised_online",
+        "id_authorised_offline",
+        "id_authorised_admin",
+    ):
+        save_tier_tags(
+            data.get("command")[len("id_authorised_") :],
+            data.get("payload"),
+            data.get("hash"),
+            data.get("chunk"),
+            data.get("chunks"),
+        )
+
+    elif data.get("command") == "sync_delta":
+        save_tags_delta(
+            data.get("base_hash"),
+            data.get("hash"),
+            data.get("add"),
+            data.get("remove"),
+        )
+
+    elif data.get("command") == "unlock":
+        if config.DEVICE_TYPE == "interlock":
+            logger.info("Turning on interlock from manual request!")
+            if hardware.interlock_power_control(True):
+                INTERLOCK_SESSION["session_id"] = (
+                    "system"  # special state - manually turned on by the system
+                )
+                hardware.interlock_session_started()
+
+            elif config.DEVICE_TYPE == "door":
+                logger.warn("Interlock power control failed!")
+                hardware.alert()
+        else:
+            logger.info("Unlocking device from manual request!")
+            hardware.unlock()
+
+    elif data.get("command") == "lock":
+        if config.DEVICE_TYPE == "door":
+            logger.info("Locking device from manual request!")
+            lock_door()
+
+        elif config.DEVICE_TYPE == "interlock":
+            logger.info("Turning off interlock from manual request!")
+            interlock_end_session()
+    elif data.get("command") == "interlock_session_start":
+        if config.DEVICE_TYPE == "interlock":
+            logger.info("Turning on interlock from new session!")
+
+            INTERLOCK_SESSION["session_id"] = data.get("session_id")
+            INTERLOCK_SESSION["session_kwh"] = 0
+
+            if hardware.interlock_power_control(True):
+                hardware.interlock_session_started()
+
+            else:
+                logger.warn("Interlock power control failed!")
+                hardware.alert()
+
+    elif data.get("command") == "interlock_session_rejected":
+        if config.DEVICE_TYPE == "interlock":
+            logger.info("Interlock session request failed!")
+            hardware.alert()
+
+    elif data.get("command") == "interlock_session_update":
+        pass
+
+    elif data.get("command") == "debit":
+        # prefer the card the portal says it debited, if it says
+        card_id = data.get("card_id") or debit_card_id
+        debit_card_id = None
+        hardware.lcd.reset_screen()
+        logger.debug(data)
+        success = data.get("success")
+        balance = data.get("balance")
+
+        balance = f"${str(round(float(balance) / 100, 2))}" if balance else "Unknown"
+        if success:
+            logger.info("Debit successful!")
+            hardware.lcd.clear()
+            hardware.lcd.print_rocket()
+            hardware.lcd.print(f"Success! {balance}")
+            hardware.buzz_action()
+            if config.VEND_MODE and VEND.start(card_id, config.VEND_PRICE):
+                return  # check_vend() shows the standby message when it's done
+        else:
+            logger.info("Debit failed!")
+            hardware.lcd.clear()
+            hardware.lcd.print(f"Declined. {balance}")
+            hardware.play_feedback(hardware.FEEDBACK_DECLINED)
+        show_standby_message_later(config.VEND_MESSAGE_TIME * 1000)
+    else:
+        logger.warn("Unknown websocket packet!")
+        logger.warn(json.dumps(data))
+
+
+def check_inputs():
+    """Log input changes and note when the door opens."""
+    global in_1_previous_state, door_previous_state, door_opened_time
 
-while True:
-    hardware.feedWDT()
     if in_1_previous_state != hardware.get_in_1_state():
         in_1_previous_state = hardware.get_in_1_state()
         logger.info(f"In 1 sensor state changed to {in_1_previous_state}")
@@ -468,22 +911,14 @@ while True:
         else:
             door_opened_time = None
 
-    if waiting_for_door_open_time:
-        if (
-            time.ticks_diff(time.ticks_ms(), waiting_for_door_open_time)
-            > config.DOOR_SENSOR_TIMEOUT * 1000
-        ):
-            logger.info("Door sensor timeout! Locking again.")
-            lock_door()
 
-        else:
-            # if the door has been opened, let's lock it immediately
-            if hardware.get_door_sensor_state():
-                logger.info("Door opened while waiting, locking in 0.5s.")
-                time.sleep(0.5)
-                lock_door()
-
-        print_device_standby_message()
+def check_door():
+    """Lock the door again when it's time, and sound the alarm if it's left open."""
+    reason = DOOR_LOCK.update()
+    if reason == "opened":
+        logger.info("Door opened, locked again.")
+    elif reason == "timeout" and config.DOOR_SENSOR_ENABLED:
+        logger.info("Door sensor timeout! Locked again.")
 
     # if the door has been open too long
     if door_opened_time and config.DOOR_OPEN_ALARM_TIMEOUT:
@@ -496,252 +931,266 @@ while True:
             hardware.lcd.print("Door Left Open!")
             hardware.buzzer_on()
 
+
+def check_vend():
+    """Stop vending when it's done, and refund the card if the machine didn't vend."""
+    result = VEND.update()
+    if result == "vended":
+        logger.info("Vend complete.")
+    elif result == "timeout":
+        logger.warn("Vend timed out! Refunding.")
+        # queued even if we're offline, so it's sent when we reconnect
+        OUTBOX.put(
+            packets.REFUND(
+                card_id_to_json(VEND.card_id), VEND.amount / 100, "vend_timeout"
+            ),
+            outbox.PRIORITY_HIGH,
+        )
+        hardware.lcd.clear()
+        hardware.lcd.print("Failed. Refunded")
+        hardware.alert()
+    if result:
+        show_standby_message_later(config.VEND_MESSAGE_TIME * 1000)
+
+
+def poll_card_reader():
+    global last_card_id
+
+    # card IDs stay as ints, they're only converted to strings for the portal
+    if config.WIEGAND_ENABLED:
+        # swipes wait in the reader's buffer while a long action runs, so
+        # log how long this one waited to be handled
+        card = None
+        if event := rfid_reader.read_event():
+            card, swiped = event
+            waited = time.ticks_diff(time.ticks_ms(), swiped)
+            logger.info(f"Got a card: {card} (swiped {waited} ms ago)")
+    elif card := rfid_reader.read_card():
+        logger.info(f"Got a card: {card}")
+
+    if card:
+        if config.BUZZ_ON_SWIPE:
+            hardware.buzz_card_read()
+
+        if config.DEVICE_TYPE == "door":
+            handle_swipe_door(card)
+
+        elif config.DEVICE_TYPE == "interlock":
+            handle_swipe_interlock(card)
+
+        elif config.DEVICE_TYPE == "memberbucks":
+            handle_swipe_memberbucks(card)
+
+        last_card_id = card
+
+
+def finish_loading_tags():
+    # the tag indexes are built in the background after boot
+    if load_tags_step():
+        TASKS.cancel(load_tags_task)
+
+
+def maintain_websocket():
+    # (re)connect the websocket in the background once WiFi is up
+    if not (websocket and websocket.open) and sta_if.isconnected():
+        connect_websocket()
+
+
+def receive_packet():
+    if not (websocket and websocket.open):
+        return
+
+    # each frame is a view of the websocket's receive buffer, decoded in place
+    # without copying it or joining fragmented packets first
+    try:
+        # this also sends the keepalive pings, so it fails if the link drops
+        frame = websocket.recv_chunk()
+    except Exception as e:
+        drop_websocket()
+        logger.error("Websocket not open, trying to reconnect.")
+        logger.error(e)
+        hardware.status_led_off()
+        return
+
+    if frame:
+        data, final = frame
+        if config.LOG_LEVEL <= ulogging.DEBUG:
+            logger.debug("Got websocket packet:")
+            logger.debug(bytes(data))
+
+        try:
+            data = decode_packet(data, final)
+            if data is not None:
+                handle_packet(data)
+
+        except Exception as e:
+            logger.error("Error parsing websocket packet!")
+            logger.error(str(e))
+
+
+def flash_wifi_led():
+    global wifi_status_led_toggle
+
+    # if WiFi still isn't connected, flash the wifi LED
+    if not sta_if.isconnected():
+        if wifi_status_led_toggle:
+            hardware.status_led_off()
+            wifi_status_led_toggle = False
+
+        else:
+            hardware.status_led_on()
+            wifi_status_led_toggle = True
+
+
+def send_ping():
+    # a dead link is detected by the websocket's own keepalive pings, which
+    # close it. This ping lets the portal monitor the link.
+    if websocket and websocket.open:
+        try:
+            logger.debug("sending ping")
+            send_packet(packets.PING(websocket.rtt_stats()), outbox.PRIORITY_LOW)
+            hardware.status_led_on()
+        except Exception as e:
+            drop_websocket()
+            logger.error("Websocket not open, trying to reconnect.")
+            logger.error(e)
+            hardware.status_led_off()
+
+
+def update_interlock_session():
+    if not (websocket and websocket.open):
+        return
+
+    if (
+        INTERLOCK_SESSION.get("session_id") is not None
+        and INTERLOCK_SESSION.get("session_id") != "system"
+    ):
+        INTERLOCK_SESSION["session_kwh"] = hardware.get_interlock_power_usage()
+        logger.debug("Sending interlock session update")
+        interlock_packet = packets.INTERLOCK_SESSION_UPDATE(
+            INTERLOCK_SESSION.get("session_id"),
+            INTERLOCK_SESSION.get("session_kwh"),
+        )
+        try:
+            send_packet(interlock_packet, outbox.PRIORITY_HIGH)
+        except Exception as e:
+            logger.error("Failed to send interlock session update!")
+            logger.error(e)
+            drop_websocket()
+
+
+def check_wifi():
+    """
+    Start reconnecting if WiFi has dropped, without waiting for it. The radio
+    associates in the background, so connect() is only called again once it
+    has stopped trying, not in the middle of an attempt.
+    """
+    global local_ip
+
+    if sta_if.isconnected():
+        local_ip = sta_if.ifconfig()[0]  # update our local IP address
+        return
+
+    if sta_if.status() == network.STAT_CONNECTING:
+        return
+
+    logger.warn("WiFi is not connected, trying to reconnect...")
+    if not sta_if.active():
+        sta_if.active(True)
     try:
-        if card := rfid_reader.read_card():
-            card = str(card)
-            logger.info(f"Got a card: {card}")
+        sta_if.connect(config.WIFI_SSID, config.WIFI_PASS)
+    except OSError as e:
+        logger.error(e)
 
-            if config.BUZZ_ON_SWIPE:
-                hardware.buzz_card_read()
 
-            if config.DEVICE_TYPE == "door":
-                handle_swipe_door(card)
+def serve_http():
+    # backup http server for manually bumping a door from the local network
+    for _ in poll.poll(0):
+        conn, addr = httpserver.sock.accept()
+        request = str(conn.recv(2048))
+        hardware.rgb_led_set(hardware.RGB_PURPLE)
+        logger.info("got http request!")
+        logger.info(request)
+        time.sleep(0.1)
+        hardware.rgb_led_set(hardware.RGB_BLUE)
+        httpserver.client_response(conn)
+        if f"/bump?secret={config.API_SECRET}" in request:
+            logger.info("got authenticated bump request")
+            unlock_door()
+            break
 
-            elif config.DEVICE_TYPE == "interlock":
-                handle_swipe_interlock(card)
 
-            elif config.DEVICE_TYPE == "memberbucks":
-                handle_swipe_memberbucks(card)
+# Only do the minimum before starting the main loop so we can accept swipes
+# as soon as possible. The tags finish loading and the network comes up in
+# the background while the main loop runs.
+get_state()  # grab the state from the flash
+load_tags()  # open the saved tags on flash
+connect_wifi(silent=True)  # start connecting to wifi
 
-            # dedupe card reads; keep looping until we've cleared the buffer
-            # while not rfid_reader.read_card():
-            #     pass
-            last_card_id = card
-            card = None
+http_server_ready = False
+if config.ENABLE_BACKUP_HTTP_SERVER:
+    import uselect
 
-        # if WiFi still isn't connected, flash the wifi LED
-        if not sta_if.isconnected():
-            if time.ticks_diff(time.ticks_ms(), wifi_status_led_update) > 250:
-                wifi_status_led_update = time.ticks_ms()
+    logger.warning(
+        "The backup http server is enabled. This is not recommended for production use!"
+    )
 
-                if wifi_status_led_toggle:
-                    hardware.status_led_off()
-                    wifi_status_led_toggle = False
+    # try to set up the http server
+    if not httpserver.setup_http_server():
+        logger.error("FAILED to setup http server on startup :(")
+    else:
+        poll = uselect.poll()
+        poll.register(httpserver.sock, uselect.POLLIN)
+        http_server_ready = True
+else:
+    logger.debug("Backup http server disabled!")
 
-                else:
-                    hardware.status_led_on()
-                    wifi_status_led_toggle = True
+logger.info(f"Starting main loop {time.ticks_ms()} ms after power on...")
+hardware.rgb_led_set(hardware.RGB_BLUE)
 
-        if (
-            time.ticks_diff(time.ticks_ms(), ten_second_cron_update)
-            > config.CRON_PERIOD
-        ):
-            ten_second_cron_update = time.ticks_ms()
-            gc.collect()
 
-            # if we've missed at least 3 consecutive pongs, then reconnect
-            if time.ticks_diff(time.ticks_ms(), last_pong) > config.CRON_PERIOD * 3:
-                websocket = None
-                logger.info("Websocket not open (pong timeout), trying to reconnect.")
-                print_device_standby_message()
+print_device_standby_message()
 
-                # this stops us trying to reconnect every 10 seconds and holding up the main loop
-                last_pong = time.ticks_ms()
 
-            if websocket and websocket.open:
-                try:
-                    logger.debug("sending ping")
-                    websocket.send(json.dumps({"command": "ping"}))
-                    hardware.status_led_on()
-                except Exception as e:
-                    websocket = None
-                    logger.error("Websocket not open, trying to reconnect.")
-                    logger.error(e)
-                    hardware.status_led_off()
-                    continue
-
-                if (
-                    INTERLOCK_SESSION.get("session_id") is not None
-                    and INTERLOCK_SESSION.get("session_id") != "system"
-                ):
-                    INTERLOCK_SESSION["session_kwh"] = (
-                        hardware.get_interlock_power_usage()
-                    )
-                    logger.debug("Sending interlock session update")
-                    interlock_packet = {
-                        "command": "interlock_session_update",
-                        "session_id": INTERLOCK_SESSION.get("session_id"),
-                        "session_kwh": INTERLOCK_SESSION.get("session_kwh"),
-                    }
-                    try:
-                        websocket.send(json.dumps(interlock_packet))
-                    except Exception as e:
-                        logger.error("Failed to send interlock session update!")
-                        logger.error(e)
-                        websocket = None
-                        continue
+door_previous_state = hardware.get_door_sensor_state()
+in_1_previous_state = hardware.get_in_1_state()
+wifi_status_led_toggle = False
 
-            else:
-                logger.info("Websocket not open, trying to reconnect.")
-                connect_websocket()
+hardware.out_1_on()
 
-            if sta_if.isconnected():
-                local_ip = sta_if.ifconfig()[0]  # update our local IP address
+# swipes and sensors get a turn between every other task, and background work
+# only runs when there's time to spare
+TASKS = scheduler.Scheduler(config.SCHEDULER_IDLE_SLICE)
+TASKS.every(0, check_inputs, scheduler.PRIORITY_HIGH)
+TASKS.every(0, hardware.update_feedback, scheduler.PRIORITY_HIGH)
+TASKS.every(0, poll_card_reader, scheduler.PRIORITY_HIGH)
+TASKS.every(50, check_door)
+if config.VEND_MODE:
+    TASKS.every(50, check_vend)
+load_tags_task = TASKS.every(0, finish_loading_tags)
+TASKS.every(0, maintain_websocket)
+TASKS.every(0, receive_packet)
+TASKS.every(0, send_queued_packets, budget_ms=config.OUTBOX_DRAIN_BUDGET)
+TASKS.every(250, flash_wifi_led)
+if http_server_ready:
+    TASKS.every(0, serve_http)
+TASKS.every(config.CRON_PERIOD, send_ping, scheduler.PRIORITY_IDLE)
+TASKS.every(config.CRON_PERIOD, update_interlock_session, scheduler.PRIORITY_IDLE)
+TASKS.every(config.CRON_PERIOD, check_wifi, scheduler.PRIORITY_IDLE)
+TASKS.every(config.CRON_PERIOD, gc.collect, scheduler.PRIORITY_IDLE, name="gc")
+# write any state changes to flash once they've settled
+TASKS.every(
+    100,
+    lambda: save_state(config.STATE_SAVE_DELAY),
+    scheduler.PRIORITY_IDLE,
+    name="save_state",
+)
 
-        if websocket and websocket.open:
-            if data := websocket.recv():
-                logger.debug("Got websocket packet:")
-                logger.debug(data)
+while True:
+    hardware.feedWDT()
 
-                try:
-                    data = json.loads(data)
-
-                    if data.get("authorised") is not None:
-                        logger.info("Got authorisation packet.")
-                        print_device_standby_message()
-
-                    elif data.get("command") == "pong":
-                        last_pong = time.ticks_ms()
-
-                    elif data.get("command") == "ping":
-                        websocket.send(json.dumps({"command": "pong"}))
-
-                    elif data.get("command") == "reboot":
-                        logger.warn("Rebooting device!")
-                        if config.DEVICE_TYPE == "interlock":
-                            interlock_end_session()
-                        else:
-                            hardware.lock()
-                            hardware.buzz_action()
-                        hardware.rgb_led_set(hardware.RGB_OFF)
-                        reset()
-
-                    elif data.get("command") == "update_device_locked_out":
-                        locked_out = data.get("locked_out")
-                        logger.info(f"Updating device locked out {locked_out}!")
-                        STATE["locked_out"] = locked_out
-                        save_state(STATE)
-
-                    elif data.get("command") == "bump" and config.DEVICE_TYPE == "door":
-                        logger.info("Bumping Door!")
-                        unlock_door()
-
-                    elif data.get("command") == "sync":
-                        tags_hash_new = data.get("hash")
-                        tags_hash_current = STATE.get("tag_hash")
-
-                        if tags_hash_new != tags_hash_current:
-                            save_tags(data.get("tags"))
-                            STATE["tag_hash"] = tags_hash_new
-                            save_state(STATE)
-                            logger.info(f"Saved tags with hash: {tags_hash_new}")
-                        else:
-                            logger.info("Tags hash unchanged, skipping save.")
-
-                    elif data.get("command") == "unlock":
-                        if config.DEVICE_TYPE == "interlock":
-                            logger.info("Turning on interlock from manual request!")
-                            if hardware.interlock_power_control(True):
-                                INTERLOCK_SESSION["session_id"] = (
-                                    "system"  # special state - manually turned on by the system
-                                )
-                                hardware.interlock_session_started()
-
-                            elif config.DEVICE_TYPE == "door":
-                                logger.warn("Interlock power control failed!")
-                                hardware.alert()
-                        else:
-                            logger.info("Unlocking device from manual request!")
-                            hardware.unlock()
-
-                    elif data.get("command") == "lock":
-                        if config.DEVICE_TYPE == "door":
-                            logger.info("Locking device from manual request!")
-                            hardware.lock()
-
-                        elif config.DEVICE_TYPE == "interlock":
-                            logger.info("Turning off interlock from manual request!")
-                            interlock_end_session()
-                    elif data.get("command") == "interlock_session_start":
-                        if config.DEVICE_TYPE == "interlock":
-                            logger.info("Turning on interlock from new session!")
-
-                            INTERLOCK_SESSION["session_id"] = data.get("session_id")
-                            INTERLOCK_SESSION["session_kwh"] = 0
-
-                            if hardware.interlock_power_control(True):
-                                hardware.interlock_session_started()
-
-                            else:
-                                logger.warn("Interlock power control failed!")
-                                hardware.alert()
-
-                    elif data.get("command") == "interlock_session_rejected":
-                        if config.DEVICE_TYPE == "interlock":
-                            logger.info("Interlock session request failed!")
-                            hardware.alert()
-
-                    elif data.get("command") == "interlock_session_update":
-                        pass
-
-                    elif data.get("command") == "debit":
-                        hardware.lcd.reset_screen()
-                        logger.debug(data)
-                        success = data.get("success")
-                        balance = data.get("balance")
-
-                        balance = (
-                            f"${str(round(float(balance) / 100, 2))}"
-                            if balance
-                            else "Unknown"
-                        )
-                        if success:
-                            logger.info("Debit successful!")
-                            hardware.lcd.clear()
-                            hardware.lcd.print_rocket()
-                            hardware.lcd.print(f"Success! {balance}")
-                            hardware.buzz_action()
-                            hardware.vend_product()
-                            time.sleep(5)
-                        else:
-                            logger.info("Debit failed!")
-                            hardware.lcd.clear()
-                            hardware.lcd.print(f"Declined. {balance}")
-                            hardware.lcd.no_backlight()
-                            hardware.rgb_led_set(hardware.RGB_RED)
-                            time.sleep(0.25)
-                            hardware.lcd.backlight()
-                            time.sleep(0.25)
-                            hardware.lcd.no_backlight()
-                            time.sleep(0.25)
-                            hardware.lcd.backlight()
-                            hardware.feedWDT()
-                            time.sleep(5)
-                            hardware.rgb_led_set(hardware.RGB_BLUE)
-                        print_device_standby_message()
-                    else:
-                        logger.warn("Unknown websocket packet!")
-                        logger.warn(json.dumps(data))
-
-                except Exception as e:
-                    logger.error("Error parsing JSON websocket packet!")
-                    logger.error(str(e))
-
-        if config.ENABLE_BACKUP_HTTP_SERVER:
-            # backup http server for manually bumping a door from the local network
-            for _ in poll.poll(1):
-                conn, addr = httpserver.sock.accept()
-                request = str(conn.recv(2048))
-                hardware.rgb_led_set(hardware.RGB_PURPLE)
-                logger.info("got http request!")
-                logger.info(request)
-                time.sleep(0.1)
-                hardware.rgb_led_set(hardware.RGB_BLUE)
-                httpserver.client_response(conn)
-                if f"/bump?secret={config.API_SECRET}" in request:
-                    logger.info("got authenticated bump request")
-                    hardware.door_swipe_success()
-                    break
+    try:
+        TASKS.run()
 
     except KeyboardInterrupt as e:
         # turn off the LED and buzzer in case they were left on
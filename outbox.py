@@ -0,0 +1,107 @@
+"""
+outbox.py - queue of packets waiting to be sent to the portal
+
+Sending a packet over a slow TLS link can take long enough to hold up the
+door, so packets are queued as dicts (or packets.Packet) and the main loop
+drains the queue when it has time. Packets are only serialised when they're
+sent, several are written to the socket at once, and more important packets
+go first.
+
+The queue is bounded. When it's full the oldest packet of the least
+important class is dropped (the new one, if everything queued is more
+important) and counted in `dropped`.
+"""
+
+import json
+import time
+import ulogging
+
+logger = ulogging.getLogger("outbox")
+
+# priority classes, most important first
+PRIORITY_HIGH = 0  # access logs, interlock sessions and debits
+PRIORITY_NORMAL = 1  # replies to the portal and sync requests
+PRIORITY_LOW = 2  # pings
+PRIORITIES = 3
+
+MAX_BATCH_BYTES = 1024  # stop adding packets to a socket write after this
+
+
+class Outbox:
+    def __init__(self, size, encode=json.dumps):
+        """
+        size   - the most packets to hold before dropping some
+        encode - turns a packet into the str or bytes sent as a message
+        """
+        self.size = size
+        self.encode = encode
+        self.dropped = 0
+        self._queues = [[] for _ in range(PRIORITIES)]
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def put(self, packet, priority=PRIORITY_NORMAL):
+        """Queue a packet. Returns False if it was dropped because we're full."""
+        if self._count >= self.size:
+            for lowest in range(PRIORITIES - 1, priority - 1, -1):
+                if self._queues[lowest]:
+                    break
+            else:
+                self._drop(packet)
+                return False
+            self._drop(self._queues[lowest].pop(0))
+            self._count -= 1
+
+        self._queues[priority].append(packet)
+        self._count += 1
+        return True
+
+    def _drop(self, packet):
+        self.dropped += 1
+        logger.warning("Outbox full, dropped %s packet.", packet.get("command"))
+
+    def clear(self):
+        for queue in self._queues:
+            queue.clear()
+        self._count = 0
+
+    def _pop(self):
+        for queue in self._queues:
+            if queue:
+                self._count -= 1
+                return queue.pop(0)
+
+    def drain(self, websocket, budget_ms):
+        """
+        Send queued packets, most important first, until the queue is empty,
+        budget_ms has passed or the socket can't take any more. Packets are
+        sent in batches of up to MAX_BATCH_BYTES with one socket write each,
+        and the rest of a batch the socket didn't take is sent first next
+        time. Returns how many were sent. A batch that fails to send is lost,
+        and the exception is raised.
+        """
+        start = time.ticks_ms()
+        sent = 0
+
+        if not websocket.flush():
+            return sent
+
+        while self._count:
+            batch = []
+            batch_bytes = 0
+            while self._count and batch_bytes < MAX_BATCH_BYTES:
+                message = self.encode(self._pop())
+                batch.append(message)
+                batch_bytes += len(message)
+
+            written = websocket.send_many(batch)
+            sent += len(batch)
+            if not written:
+                break
+
+            if time.ticks_diff(time.ticks_ms(), start) >= budget_ms:
+                break
+
+        return sent
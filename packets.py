@@ -0,0 +1,107 @@
+"""
+packets.py - preformatted templates for the packets sent most often
+
+Building a dict for every swipe, ping and session update and then encoding
+the whole thing spends time and heap on the parts that never change. A
+Template encodes those parts once, in both JSON and CBOR, and only the
+variable fields are encoded when a packet is sent:
+
+    LOG_ACCESS = Template("log_access", "card_id")
+    OUTBOX.put(LOG_ACCESS(card_id))
+
+Outbox queues the Packet like a dict. Give it encode_json or encode_cbor as
+its encoder, they encode Packets from their template and dicts as before.
+"""
+
+import json
+import cbor
+
+
+class Template:
+    def __init__(self, command, *fields):
+        """
+        command - the packet's command
+        fields  - names of the fields given when a packet is made, in order
+        """
+        self.command = command
+        self.fields = fields
+
+        # a % format string with a %s for each field's JSON. A template
+        # without fields is just the packet
+        json_format = '{"command": ' + json.dumps(command).replace("%", "%%")
+        for field in fields:
+            json_format += ", " + json.dumps(field).replace("%", "%%") + ": %s"
+        json_format += "}"
+        self._json = json_format if fields else json_format % ()
+
+        self._cbor_prefix = (
+            cbor.map_header(len(fields) + 1)
+            + cbor.dumps("command")
+            + cbor.dumps(command)
+        )
+        self._cbor_keys = [cbor.dumps(field) for field in fields]
+
+    def __call__(self, *values):
+        """Make a packet with these field values."""
+        if len(values) != len(self.fields):
+            raise TypeError("%s takes %s fields" % (self.command, len(self.fields)))
+        return Packet(self, values)
+
+
+class Packet:
+    """A packet made from a Template, encoded when it's sent."""
+
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def get(self, key, default=None):
+        """Look up a field like a dict packet (e.g. "command")."""
+        if key == "command":
+            return self.template.command
+        for field, value in zip(self.template.fields, self.values):
+            if field == key:
+                return value
+        return default
+
+    def json(self):
+        if not self.values:
+            return self.template._json
+        return self.template._json % tuple(map(json.dumps, self.values))
+
+    def cbor(self):
+        template = self.template
+        if not self.values:
+            return template._cbor_prefix
+        out = bytearray(template._cbor_prefix)
+        for key, value in zip(template._cbor_keys, self.values):
+            out.extend(key)
+            cbor.encode_into(out, value)
+        return bytes(out)
+
+
+def encode_json(packet):
+    """Encode a Packet or dict packet as JSON, for Outbox."""
+    if isinstance(packet, Packet):
+        return packet.json()
+    return json.dumps(packet)
+
+
+def encode_cbor(packet):
+    """Encode a Packet or dict packet as CBOR, for Outbox."""
+    if isinstance(packet, Packet):
+        return packet.cbor()
+    return cbor.dumps(packet)
+
+
+# the packets sent most often
+PING = Template("ping", "rtt")
+PONG = Template("pong")
+LOG_ACCESS = Template("log_access", "card_id")
+LOG_ACCESS_DENIED = Template("log_access_denied", "card_id")
+LOG_ACCESS_LOCKED_OUT = Template("log_access_locked_out", "card_id")
+INTERLOCK_SESSION_UPDATE = Template(
+    "interlock_session_update", "session_id", "session_kwh"
+)
+DEBIT = Template("debit", "card_id", "amount")
+REFUND = Template("refund", "card_id", "amount", "reason")
@@ -0,0 +1,157 @@
+"""
+scheduler.py - cooperative task scheduler for the main loop
+
+Each job the main loop does (reading cards, websocket packets, pings, ...)
+is a task that runs every period_ms, or once after a delay. Tasks can't be
+interrupted, so each one should do a little work and return.
+
+On each pass of run() due tasks run in priority order:
+
+- high priority tasks (swipes, sensors) run first, and again after every
+  other task, so a swipe waits for at most one other task instead of a whole
+  pass of the loop
+- normal priority tasks all run when they're due
+- idle priority tasks (background work like pings, energy polling and gc)
+  run one per pass, the one that's waited longest, and only if the pass
+  hasn't already used idle_slice_ms. One that's waited MAX_IDLE_WAIT_MS runs
+  anyway so a busy loop can't starve it.
+
+A task that takes longer than its budget_ms is counted in `overruns` and
+logged at debug level, so slow tasks show up.
+
+    tasks = Scheduler()
+    tasks.every(0, read_card, scheduler.PRIORITY_HIGH)
+    tasks.every(10000, send_ping, scheduler.PRIORITY_IDLE, budget_ms=20)
+    tasks.after(500, lock_door)
+    while True:
+        tasks.run()
+"""
+
+import time
+import ulogging
+
+logger = ulogging.getLogger("scheduler")
+
+PRIORITY_HIGH = 0  # run first, and again between other tasks
+PRIORITY_NORMAL = 1
+PRIORITY_IDLE = 2  # run when a pass has time to spare
+PRIORITIES = 3
+
+MAX_IDLE_WAIT_MS = 1000  # run an idle task anyway once it's this late
+
+
+class Task:
+    def __init__(self, function, period_ms, priority, budget_ms, name):
+        self.function = function
+        self.period_ms = period_ms  # None for a task that runs once
+        self.priority = priority
+        self.budget_ms = budget_ms
+        self.name = name or function.__name__
+        self.next_run = None
+        self.cancelled = False
+
+        self.runs = 0
+        self.overruns = 0  # runs that took longer than budget_ms
+        self.max_ms = 0  # the longest run
+
+
+class Scheduler:
+    def __init__(self, idle_slice_ms=10):
+        """
+        idle_slice_ms - idle tasks only run in a pass that's taken less time
+                        than this so far
+        """
+        self.idle_slice_ms = idle_slice_ms
+        self._tasks = [[] for _ in range(PRIORITIES)]
+        self._cancelled = False  # some tasks need removing after this pass
+
+    def every(
+        self, period_ms, function, priority=PRIORITY_NORMAL, budget_ms=None, name=None
+    ):
+        """
+        Run function() every period_ms (0 for every pass), starting with the
+        next pass. Returns the Task.
+        """
+        task = Task(function, period_ms, priority, budget_ms, name)
+        return self._add(task, 0)
+
+    def after(
+        self, delay_ms, function, priority=PRIORITY_NORMAL, budget_ms=None, name=None
+    ):
+        """Run function() once, delay_ms from now. Returns the Task."""
+        task = Task(function, None, priority, budget_ms, name)
+        return self._add(task, delay_ms)
+
+    def _add(self, task, delay_ms):
+        task.next_run = time.ticks_add(time.ticks_ms(), delay_ms)
+        self._tasks[task.priority].append(task)
+        return task
+
+    def cancel(self, task):
+        """Stop a task from running again. Cancelling twice does nothing."""
+        if task is not None and not task.cancelled:
+            task.cancelled = True
+            self._cancelled = True
+
+    def _due(self, task, now):
+        return not task.cancelled and time.ticks_diff(now, task.next_run) >= 0
+
+    def _run(self, task, now):
+        # reschedule first, so a task that raises doesn't run again straight away
+        if task.period_ms is None:
+            self.cancel(task)
+        else:
+            task.next_run = time.ticks_add(now, task.period_ms)
+
+        task.function()
+
+        elapsed = time.ticks_diff(time.ticks_ms(), now)
+        task.runs += 1
+        if elapsed > task.max_ms:
+            task.max_ms = elapsed
+        if task.budget_ms is not None and elapsed > task.budget_ms:
+            task.overruns += 1
+            logger.debug(
+                "Task %s took %s ms, its budget is %s ms.",
+                task.name,
+                elapsed,
+                task.budget_ms,
+            )
+
+    def _run_high_priority(self):
+        for task in self._tasks[PRIORITY_HIGH]:
+            now = time.ticks_ms()
+            if self._due(task, now):
+                self._run(task, now)
+
+    def run(self):
+        """Run one pass of the due tasks."""
+        start = time.ticks_ms()
+
+        self._run_high_priority()
+
+        for task in self._tasks[PRIORITY_NORMAL]:
+            now = time.ticks_ms()
+            if self._due(task, now):
+                self._run(task, now)
+                self._run_high_priority()
+
+        now = time.ticks_ms()
+        idle = None
+        for task in self._tasks[PRIORITY_IDLE]:
+            if self._due(task, now) and (
+                idle is None or time.ticks_diff(idle.next_run, task.next_run) > 0
+            ):
+                idle = task
+        if idle is not None and (
+            time.ticks_diff(now, start) < self.idle_slice_ms
+            or time.ticks_diff(now, idle.next_run) >= MAX_IDLE_WAIT_MS
+        ):
+            self._run(idle, now)
+            self._run_high_priority()
+
+        if self._cancelled:
+            self._cancelled = False
+            self._tasks = [
+                [task for task in tasks if not task.cancelled] for tasks in self._tasks
+            ]
@@ -0,0 +1,135 @@
+"""
+storage.py - crash-safe persistence for files on flash
+
+Files are written to a temporary file which is then renamed over the live one,
+so a brown-out mid-write leaves the previous copy intact. JSON files carry a
+crc32 on a second line so a damaged file is detected instead of half-loaded.
+"""
+
+import json
+import os
+import time
+import ubinascii
+import ulogging
+
+logger = ulogging.getLogger("storage")
+
+
+def replace_file(tmp_path, path):
+    """Move tmp_path over path in one step."""
+    try:
+        # atomic on littlefs, the old file is replaced in one step
+        os.rename(tmp_path, path)
+    except OSError:
+        # some filesystems (FAT) won't rename over an existing file
+        os.remove(path)
+        os.rename(tmp_path, path)
+
+
+def _checksum(body):
+    return "%08x" % (ubinascii.crc32(body.encode()) & 0xFFFFFFFF)
+
+
+def write_json(path, data):
+    body = json.dumps(data)
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "w") as tmp_file:
+        tmp_file.write(body)
+        tmp_file.write("\n")
+        tmp_file.write(_checksum(body))
+        tmp_file.write("\n")
+
+    replace_file(tmp_path, path)
+
+
+def _parse_json(content):
+    content = content.strip()
+    split = content.rfind("\n")
+
+    # files written before checksums were added are plain JSON
+    if split == -1:
+        return json.loads(content)
+
+    body = content[:split]
+    if content[split + 1 :] != _checksum(body):
+        raise ValueError("checksum mismatch")
+    return json.loads(body)
+
+
+def read_json(path):
+    """
+    Read a JSON file written by write_json. If it's damaged, fall back to a
+    complete temporary file left behind by an interrupted write.
+    """
+    for candidate in (path, path + ".tmp"):
+        try:
+            with open(candidate) as json_file:
+                return _parse_json(json_file.read())
+        except OSError:
+            pass
+        except ValueError as e:
+            logger.error("%s is damaged (%s)", candidate, str(e))
+
+    raise OSError("No valid copy of " + path)
+
+
+class JsonStore:
+    """
+    A dict saved to a JSON file. Changes only mark the store as dirty, and
+    flush() writes them all to flash at once (and only if something changed).
+    """
+
+    def __init__(self, path, defaults):
+        self.path = path
+        self.data = dict(defaults)
+        self.dirty = False
+        self._dirty_since = None
+
+    def load(self):
+        """Load the file, or create it from the defaults if it doesn't exist."""
+        try:
+            self.data.update(read_json(self.path))
+            return True
+        except OSError:
+            self.dirty = True
+            self.flush()
+            return False
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        if key in self.data and self.data[key] == value:
+            return
+        self.data[key] = value
+        self.mark_dirty()
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def mark_dirty(self):
+        if not self.dirty:
+            self.dirty = True
+            self._dirty_since = time.ticks_ms()
+
+    def flush(self, delay_ms=0):
+        """
+        Write the store if it's dirty. With a delay, wait until it's been dirty
+        for that long so a burst of changes is written once. Returns True if
+        the file was written.
+        """
+        if not self.dirty:
+            return False
+
+        if (
+            delay_ms
+            and self._dirty_since is not None
+            and time.ticks_diff(time.ticks_ms(), self._dirty_since) < delay_ms
+        ):
+            return False
+
+        write_json(self.path, self.data)
+        self.dirty = False
+        self._dirty_since = None
+        return True
@@ -0,0 +1,485 @@
+"""
+tagstore.py - compact index of authorised RFID card IDs
+
+Card IDs are stored as a sorted array of uint32 values and looked up with a
+binary search. This uses 4 bytes of heap per tag (instead of one string object
+per tag) and each lookup is O(log n) instead of a scan of the whole list.
+
+TagStore keeps the array in RAM. FlashTagStore keeps it in a binary tag file
+and only holds a small page index in RAM, so capacity scales with flash.
+
+Tag file format (little-endian):
+    header  - magic "BBTG", version (u8), hash length (u8), reserved (u16),
+              tag count (u32), crc32 of the card IDs (u32)
+    hash    - the portal's tag hash (utf-8, "hash length" bytes)
+    tags    - sorted card IDs, one u32 each
+"""
+
+from array import array
+import json
+import os
+import ubinascii
+import ustruct
+import ulogging
+import storage
+
+logger = ulogging.getLogger("tagstore")
+
+MAX_CARD_ID = 0xFFFFFFFF
+
+FILE_MAGIC = b"BBTG"
+FILE_VERSION = 1
+HEADER_FORMAT = "<4sBBHII"
+HEADER_SIZE = ustruct.calcsize(HEADER_FORMAT)
+PAGE_SIZE = 64  # card IDs per page read from flash (256 bytes)
+
+
+def to_card_id(tag):
+    """
+    Convert a tag (an int, or a decimal string from the portal) to an int card
+    ID. Returns None if it can't be stored as a uint32.
+    """
+    if isinstance(tag, int):
+        card_id = tag
+    else:
+        try:
+            card_id = int(tag)
+        except (TypeError, ValueError):
+            return None
+
+    if 0 <= card_id <= MAX_CARD_ID:
+        return card_id
+    return None
+
+
+def _is_sorted(ids):
+    for i in range(1, len(ids)):
+        if ids[i - 1] > ids[i]:
+            return False
+    return True
+
+
+def sort_ids(ids):
+    """
+    Sort an array of card IDs in place, with an LSD radix sort (one pass per
+    byte). MicroPython arrays have no sort() and sorted() would build a list
+    of every tag, so this only needs one spare array of the same size.
+    """
+    count = len(ids)
+    if _is_sorted(ids):
+        return
+
+    src = ids
+    dst = array("I", ids)
+    counts = array("I", [0] * 256)
+
+    for shift in (0, 8, 16, 24):
+        for digit in range(256):
+            counts[digit] = 0
+        for card_id in src:
+            counts[(card_id >> shift) & 0xFF] += 1
+
+        # skip this byte if every ID has the same value for it
+        if counts[(src[0] >> shift) & 0xFF] == count:
+            continue
+
+        # turn the counts into the offset of each digit's bucket
+        total = 0
+        for digit in range(256):
+            bucket = counts[digit]
+            counts[digit] = total
+            total += bucket
+
+        for card_id in src:
+            digit = (card_id >> shift) & 0xFF
+            dst[counts[digit]] = card_id
+            counts[digit] += 1
+
+        src, dst = dst, src
+
+    if src is not ids:
+        for i in range(count):
+            ids[i] = src[i]
+
+
+def dedupe_ids(ids):
+    """Remove duplicates from a sorted array of card IDs."""
+    if not ids:
+        return ids
+
+    last = 0
+    for i in range(1, len(ids)):
+        if ids[i] != ids[last]:
+            last += 1
+            ids[last] = ids[i]
+
+    if last + 1 == len(ids):
+        return ids
+    return ids[: last + 1]
+
+
+def bisect_left(ids, card_id, lo=0, hi=None):
+    if hi is None:
+        hi = len(ids)
+
+    while lo < hi:
+        mid = (lo + hi) >> 1
+        if ids[mid] < card_id:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+def _contains(ids, card_id):
+    i = bisect_left(ids, card_id)
+    return i < len(ids) and ids[i] == card_id
+
+
+def merge_ids(old, adds, removes):
+    """
+    Yield the card IDs from old (any sorted iterable) with the sorted arrays
+    adds and removes applied, in sorted order.
+    """
+    a = 0
+    for card_id in old:
+        while a < len(adds) and adds[a] < card_id:
+            if not _contains(removes, adds[a]):
+                yield adds[a]
+            a += 1
+        if a < len(adds) and adds[a] == card_id:
+            a += 1  # already authorised
+
+        if not _contains(removes, card_id):
+            yield card_id
+
+    while a < len(adds):
+        if not _contains(removes, adds[a]):
+            yield adds[a]
+        a += 1
+
+
+def count_changes(store, added, removed):
+    """Count how many tags applying a delta to store would change."""
+    changed = 0
+    for card_id in added:
+        if card_id not in removed and card_id not in store:
+            changed += 1
+    for card_id in removed:
+        if card_id in store:
+            changed += 1
+    return changed
+
+
+class TagStore:
+    """
+    A set of authorised card IDs that supports `card in store`.
+    """
+
+    def __init__(self, tags=None):
+        self._ids = array("I")
+        self._skipped = 0
+        if tags:
+            self.build(tags)
+
+    def build(self, tags):
+        """Replace the contents of the store with tags (any iterable)."""
+        self._ids = array("I")
+        for tag in tags:
+            self.append(tag)
+        self.finish()
+
+    def append(self, tag):
+        """
+        Add a tag without keeping the store sorted, for loading tags one at a
+        time (e.g. from jsonstream). Call finish() before doing any lookups.
+        """
+        card_id = to_card_id(tag)
+        if card_id is None:
+            self._skipped += 1
+        else:
+            self._ids.append(card_id)
+
+    def finish(self):
+        if self._skipped:
+            logger.warn("Skipped %s tags that aren't valid card IDs.", self._skipped)
+            self._skipped = 0
+
+        sort_ids(self._ids)
+        self._ids = dedupe_ids(self._ids)
+
+    def apply_delta(self, added=(), removed=()):
+        """
+        Add and remove tags in one pass. Returns the number of tags changed.
+        """
+        added = _as_tag_store(added)
+        removed = _as_tag_store(removed)
+
+        changed = count_changes(self, added, removed)
+        if changed:
+            new = array("I")
+            for card_id in merge_ids(self._ids, added._ids, removed._ids):
+                new.append(card_id)
+            self._ids = new
+        return changed
+
+    def __contains__(self, card):
+        card_id = to_card_id(card)
+        if card_id is None:
+            return False
+        return _contains(self._ids, card_id)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __iter__(self):
+        return iter(self._ids)
+
+
+def _as_tag_store(tags):
+    if isinstance(tags, TagStore):
+        return tags
+    return TagStore(tags)
+
+
+def write_tag_file(path, ids, tag_hash):
+    """
+    Write sorted card IDs (any iterable) to a binary tag file. Returns the
+    number of tags written.
+    """
+    hash_bytes = (tag_hash or "").encode()
+    if len(hash_bytes) > 255:
+        raise ValueError("Tag hash is too long")
+
+    page = array("I", [0] * PAGE_SIZE)
+    count = 0
+    fill = 0
+    crc = 0
+
+    with open(path, "wb") as tag_file:
+        tag_file.write(ustruct.pack(HEADER_FORMAT, FILE_MAGIC, 0, 0, 0, 0, 0))
+        tag_file.write(hash_bytes)
+
+        for card_id in ids:
+            page[fill] = card_id
+            fill += 1
+            if fill == PAGE_SIZE:
+                crc = ubinascii.crc32(page, crc)
+                tag_file.write(page)
+                count += fill
+                fill = 0
+
+        if fill:
+            chunk = memoryview(page)[:fill]
+            crc = ubinascii.crc32(chunk, crc)
+            tag_file.write(chunk)
+            count += fill
+
+        # now we know the count and crc, fill in the real header
+        tag_file.seek(0)
+        tag_file.write(
+            ustruct.pack(
+                HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, len(hash_bytes), 0, count, crc
+            )
+        )
+
+    return count
+
+
+class FlashTagStore:
+    """
+    A set of authorised card IDs stored in a binary tag file. Only an index of
+    the first card ID in each page is kept in RAM (4 bytes per 64 tags), so a
+    lookup is a binary search of the index and then of one page from flash.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tag_hash = ""
+        self._file = None
+        self._count = 0
+        self._data_offset = 0
+        self._index = array("I")
+        self._page = array("I", [0] * PAGE_SIZE)
+        self._page_number = None  # page currently cached in self._page
+        self._page_count = 0
+        self._card = array("I", [0])
+        self._crc = 0
+        self._check = 0
+        self.loading = False
+
+    def open(self, background=False):
+        """
+        (Re)open the tag file, check it and build the page index. Returns False
+        (leaving the store empty) if the file is missing or invalid.
+
+        With background=True only the header is read, and load() must be called
+        until it returns True to finish. Lookups still work in the meantime by
+        binary searching the file directly.
+        """
+        self.close()
+
+        try:
+            tag_file = open(self.path, "rb")
+        except OSError:
+            logger.warn("No tag file found at %s", self.path)
+            return False
+
+        try:
+            header = tag_file.read(HEADER_SIZE)
+            magic, version, hash_length, _, count, crc = ustruct.unpack(
+                HEADER_FORMAT, header
+            )
+            if magic != FILE_MAGIC or version != FILE_VERSION:
+                raise ValueError("Unknown tag file format")
+
+            self.tag_hash = tag_file.read(hash_length).decode()
+
+        except Exception as e:
+            logger.error("Tag file %s is invalid, ignoring it!", self.path)
+            logger.error(str(e))
+            tag_file.close()
+            return False
+
+        self._file = tag_file
+        self._count = count
+        self._crc = crc
+        self._check = 0
+        self._data_offset = HEADER_SIZE + hash_length
+        self.loading = True
+
+        if background:
+            return True
+
+        while not self.load():
+            pass
+        return self._file is not None
+
+    def load(self, pages=8):
+        """
+        Check the next few pages of the file and add them to the page index.
+        Returns True once the whole file has been loaded (or found invalid).
+        """
+        if not self.loading:
+            return True
+
+        try:
+            for _ in range(pages):
+                number = len(self._index)
+                if number * PAGE_SIZE >= self._count:
+                    if self._check != self._crc:
+                        raise ValueError("Tag file checksum mismatch")
+                    self.loading = False
+                    return True
+
+                page_count = self._read_page(self._file, number, self._count)
+                self._check = ubinascii.crc32(
+                    memoryview(self._page)[:page_count], self._check
+                )
+                self._index.append(self._page[0])
+
+        except Exception as e:
+            logger.error("Tag file %s is invalid, ignoring it!", self.path)
+            logger.error(str(e))
+            self.close()
+            return True
+
+        return False
+
+    def close(self):
+        if self._file:
+            self._file.close()
+        self._file = None
+        self._count = 0
+        self._index = array("I")
+        self._page_number = None
+        self.loading = False
+        self.tag_hash = ""
+
+    def _search_file(self, card_id):
+        # binary search the file a card ID at a time, used until load() is done
+        lo = 0
+        hi = self._count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            self._file.seek(self._data_offset + mid * 4)
+            self._file.readinto(self._card)
+            if self._card[0] < card_id:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == self._count:
+            return False
+        self._file.seek(self._data_offset + lo * 4)
+        self._file.readinto(self._card)
+        return self._card[0] == card_id
+
+    def _read_page(self, tag_file, number, count):
+        # read a page of card IDs into self._page, returns how many were read
+        tag_file.seek(self._data_offset + number * PAGE_SIZE * 4)
+        page_count = min(PAGE_SIZE, count - number * PAGE_SIZE)
+        if tag_file.readinto(memoryview(self._page)[:page_count]) != page_count * 4:
+            raise ValueError("Tag file is truncated")
+        self._page_number = number
+        self._page_count = page_count
+        return page_count
+
+    def replace(self, ids, tag_hash):
+        """Replace every tag in the store with ids (sorted) and save the new hash."""
+        tmp_path = self.path + ".tmp"
+        count = write_tag_file(tmp_path, ids, tag_hash)
+        self.close()
+        storage.replace_file(tmp_path, self.path)
+        self.open()
+        return count
+
+    def apply_delta(self, added, removed, tag_hash):
+        """
+        Add and remove tags and save the new hash. The new file is written by
+        merging the old one with the delta, so the full tag list is never in
+        RAM. Returns the number of tags changed.
+        """
+        added = _as_tag_store(added)
+        removed = _as_tag_store(removed)
+        changed = count_changes(self, added, removed)
+        self.replace(merge_ids(self, added._ids, removed._ids), tag_hash)
+        return changed
+
+    def __contains__(self, card):
+        card_id = to_card_id(card)
+        if card_id is None or not self._count:
+            return False
+
+        if self.loading:
+            return self._search_file(card_id)
+
+        # find the last page that starts at or before this card ID
+        number = bisect_left(self._index, card_id + 1) - 1
+        if number < 0:
+            return False
+
+        if number != self._page_number:
+            self._read_page(self._file, number, self._count)
+
+        i = bisect_left(self._page, card_id, 0, self._page_count)
+        return i < self._page_count and self._page[i] == card_id
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        for number in range((self._count + PAGE_SIZE - 1) // PAGE_SIZE):
+            page_count = self._read_page(self._file, number, self._count)
+            for i in range(page_count):
+                yield self._page[i]
+
+
+def migrate_json(json_path, store, tag_hash):
+    """One-time migration of a tags.json file to a binary tag file."""
+    with open(json_path) as tags_file:
+        tags = TagStore(json.load(tags_file))
+
+    store.replace(tags, tag_hash)
+    os.remove(json_path)
+    logger.info("Migrated %s tags from %s to %s", len(tags), json_path, store.path)
@@ -0,0 +1,237 @@
+"""
+Tests for receiving websocket frames, run off the device with:
+
+    python -m unittest discover tests
+"""
+
+import os
+import struct
+import time
+import unittest
+import zlib
+
+import benchmarks.compat  # noqa: F401 aliases the micropython modules
+from uwebsockets import protocol
+
+
+def frame(opcode, payload, fin=True, mask=None):
+    """Build a frame the way the portal would send it."""
+    header = bytearray([(0x80 if fin else 0) | opcode])
+    mask_bit = 0x80 if mask else 0
+    if len(payload) < 126:
+        header.append(mask_bit | len(payload))
+    elif len(payload) < 1 << 16:
+        header.append(mask_bit | 126)
+        header.extend(struct.pack("!H", len(payload)))
+    else:
+        header.append(mask_bit | 127)
+        header.extend(struct.pack("!Q", len(payload)))
+    if mask:
+        header.extend(mask)
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return bytes(header) + payload
+
+
+class FakeSocket:
+    """A non-blocking socket that has up to `step` bytes ready at a time."""
+
+    def __init__(self, data=b"", step=1, write_step=None):
+        self.data = memoryview(data)
+        self.step = step
+        self.ready = 0  # bytes that can be read before it would block
+        self.write_step = write_step  # the most a write takes, None for all
+        self.writes = 0
+        self.written = bytearray()
+
+    def setblocking(self, flag):
+        pass
+
+    def readinto(self, buf):
+        if not self.ready:
+            self.ready = self.step  # more arrives before the next call
+            return None
+        count = min(len(buf), self.ready, len(self.data))
+        if not count:
+            return None
+        buf[:count] = self.data[:count]
+        self.data = self.data[count:]
+        self.ready -= count
+        return count
+
+    def write(self, data):
+        self.writes += 1
+        if self.write_step is None:
+            count = len(data)
+        elif self.writes % 2:
+            return None  # the socket's buffer is full
+        else:
+            count = min(len(data), self.write_step)
+        self.written.extend(data[:count])
+        return count
+
+    def close(self):
+        pass
+
+
+class Server(protocol.Websocket):
+    is_client = False
+
+
+class Client(protocol.Websocket):
+    is_client = True
+
+
+def read_frames(data):
+    """Split written bytes into (opcode, unmasked payload) frames."""
+    frames = []
+    pos = 0
+    while pos < len(data):
+        opcode = data[pos] & 0x0F
+        masked = data[pos + 1] & 0x80
+        length = data[pos + 1] & 0x7F
+        pos += 2
+        if length == 126:
+            length = struct.unpack_from("!H", data, pos)[0]
+            pos += 2
+        elif length == 127:
+            length = struct.unpack_from("!Q", data, pos)[0]
+            pos += 8
+        mask = b"\x00" * 4
+        if masked:
+            mask = data[pos : pos + 4]
+            pos += 4
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(data[pos : pos + length]))
+        frames.append((opcode, payload))
+        pos += length
+    return frames
+
+
+def receive(websocket):
+    """Read recv_chunk() pieces until a message is complete."""
+    pieces = []
+    for _ in range(100000):
+        chunk = websocket.recv_chunk()
+        if chunk is None:
+            continue
+        data, fin = chunk
+        pieces.append((bytes(data), fin))
+        if fin:
+            return pieces
+    raise AssertionError("message never finished")
+
+
+class TestStreamedFrames(unittest.TestCase):
+    MAX_SIZE = 4096
+
+    def check_streamed(self, packet, step, mask=None):
+        sock = FakeSocket(frame(protocol.OP_TEXT, packet, mask=mask), step)
+        websocket = Server(sock, max_message_size=self.MAX_SIZE)
+
+        pieces = receive(websocket)
+
+        self.assertTrue(websocket.open)
+        self.assertEqual(b"".join(data for data, _ in pieces), packet)
+        self.assertEqual([fin for _, fin in pieces][-1], True)
+        self.assertNotIn(True, [fin for _, fin in pieces][:-1])
+        for data, _ in pieces:
+            self.assertLessEqual(len(data), protocol.STREAM_CHUNK)
+        return pieces
+
+    def test_frame_bigger_than_max_message_size(self):
+        packet = os.urandom(self.MAX_SIZE * 5 + 3)
+        pieces = self.check_streamed(packet, step=1500)
+        self.assertGreater(len(pieces), 1)
+
+    def test_masked_frame_split_off_the_mask_boundary(self):
+        packet = os.urandom(self.MAX_SIZE * 2 + 1)
+        self.check_streamed(packet, step=7, mask=b"\x12\x34\x56\x78")
+
+    def test_fragments_and_pings_between_them(self):
+        packet = os.urandom(5000)
+        data = (
+            frame(protocol.OP_TEXT, packet[:3000], fin=False)
+            + frame(protocol.OP_PING, b"ping")
+            + frame(protocol.OP_CONT, packet[3000:])
+        )
+        sock = FakeSocket(data, step=100)
+        websocket = Server(sock, max_message_size=self.MAX_SIZE)
+
+        pieces = receive(websocket)
+
+        self.assertEqual(b"".join(data for data, _ in pieces), packet)
+        self.assertEqual(bytes(sock.written), frame(protocol.OP_PONG, b"ping"))
+
+    def test_compressed_message(self):
+        packet = b'{"tags": [' + b'"1234567890", ' * 1000 + b'"1"]}'
+        compress = zlib.compressobj(wbits=-9)
+        deflated = compress.compress(packet) + compress.flush(zlib.Z_SYNC_FLUSH)
+        data = bytearray(frame(protocol.OP_TEXT, deflated[:-4]))
+        data[0] |= 0x40  # RSV1, the message is compressed
+        websocket = Server(FakeSocket(data, step=100), self.MAX_SIZE, 9)
+
+        pieces = receive(websocket)
+
+        self.assertEqual(b"".join(data for data, _ in pieces), packet)
+
+    def test_recv_still_limits_whole_messages(self):
+        packet = os.urandom(self.MAX_SIZE + 1)
+        sock = FakeSocket(frame(protocol.OP_TEXT, packet), len(packet) + 16)
+        websocket = Server(sock, max_message_size=self.MAX_SIZE)
+
+        for _ in range(10):
+            if not websocket.open:
+                break
+            websocket.recv()
+
+        self.assertFalse(websocket.open)
+        close_code = struct.unpack("!H", sock.written[2:4])[0]
+        self.assertEqual(close_code, protocol.CLOSE_TOO_BIG)
+
+
+class TestShortWrites(unittest.TestCase):
+    def test_frames_survive_short_writes(self):
+        sock = FakeSocket(write_step=50)
+        websocket = Client(sock)
+        message = "x" * 700
+
+        self.assertFalse(websocket.send(message))
+        websocket.write_frame(protocol.OP_PING, b"ping")  # while send() waits
+        websocket.send_many(["one", b"two"])
+        for _ in range(100):
+            if websocket.flush():
+                break
+
+        self.assertTrue(websocket.flush())
+        self.assertEqual(
+            read_frames(sock.written),
+            [
+                (protocol.OP_TEXT, message.encode()),
+                (protocol.OP_PING, b"ping"),
+                (protocol.OP_TEXT, b"one"),
+                (protocol.OP_BYTES, b"two"),
+            ],
+        )
+
+    def test_control_frames_survive_short_writes(self):
+        sock = FakeSocket(frame(protocol.OP_PING, b"are you there"), 100, 5)
+        websocket = Client(sock)
+        websocket.keepalive(1, 10000)
+        time.sleep(0.01)  # so a keepalive ping is due
+
+        for _ in range(10):
+            websocket.recv_chunk()  # answers the portal's ping
+        for _ in range(100):
+            if websocket.flush():
+                break
+
+        self.assertEqual(
+            read_frames(sock.written),
+            [
+                (protocol.OP_PING, struct.pack("!I", 1)),
+                (protocol.OP_PONG, b"are you there"),
+            ],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
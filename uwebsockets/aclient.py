@@ -0,0 +1,183 @@
+"""
+uasyncio websockets client for micropython
+
+connect() opens the connection and does the TLS and websocket handshakes
+without blocking the event loop (the DNS lookup still blocks, as
+micropython's getaddrinfo does). The AsyncWebsocket it returns waits for
+messages and sends them with awaits instead of being polled:
+
+    websocket = await connect("wss://portal.example.com/ws/access")
+    await websocket.send("hello")
+    async for message in websocket:
+        ...
+
+Frames are parsed by the same resumable reader as the polled client. When
+it runs out of data, AsyncWebsocket waits for the socket and reads straight
+into the part of the frame it's waiting for.
+
+Every frame, including the pings, pongs and close frames the reader sends,
+is written through the stream, so frames stay whole and in order. Call
+wait_closed() when you're done with it to close the socket.
+"""
+
+import ulogging
+import uasyncio as asyncio
+
+from . import client
+from . import protocol
+from .protocol import Websocket, ConnectionClosed, urlparse
+from .protocol import OP_TEXT, OP_BYTES, OP_CLOSE
+
+LOGGER = ulogging.getLogger(__name__)
+
+
+class AsyncWebsocket(Websocket):
+    is_client = True
+
+    def __init__(self, stream, max_message_size=None, deflate_wbits=None):
+        super().__init__(stream.s, max_message_size, deflate_wbits)
+        self.stream = stream
+        self._drain_lock = asyncio.Lock()
+
+    def flush(self):
+        """Leave the frames in the send buffer for _drain() to write."""
+        return self._tx_buf is None
+
+    async def _drain(self):
+        """Write the frames in the send buffer through the stream, in order."""
+        if self._tx_buf is None:
+            return
+        # one task at a time: the stream loses anything written to it while
+        # another task is draining it
+        async with self._drain_lock:
+            while self._tx_buf is not None:
+                batch = self._tx_buf
+                self._tx_buf = None
+                self.stream.write(batch)
+                await self.stream.drain()
+
+    def _close(self):
+        # the socket's closed by wait_closed(), once the close frame's gone
+        if __debug__:
+            LOGGER.debug("Connection closed")
+        self.open = False
+
+    async def _wait_for_data(self):
+        """Wait for more of the frame being read and read it into place."""
+        read = self.stream.readinto(self._rx_view[self._rx_got :])
+        if self.ping_interval:
+            # wake up in time to send the next keepalive ping
+            try:
+                count = await asyncio.wait_for(read, self.ping_interval / 1000)
+            except asyncio.TimeoutError:
+                return
+        else:
+            count = await read
+        if count == 0:
+            LOGGER.debug("Connection closed mid frame.")
+            self._close()
+            raise ConnectionClosed()
+        if count:
+            self._rx_got += count
+
+    async def recv(self):
+        """
+        Wait for the next message. Returns str for text and bytes for binary
+        messages, or None once the connection has closed.
+        """
+        while True:
+            opcode, data = self._recv_message()
+            await self._drain()  # any pongs or keepalive pings
+
+            if opcode == OP_TEXT:
+                return str(data, "utf-8")
+            elif opcode == OP_BYTES:
+                return bytes(data)
+            elif opcode == OP_CLOSE:
+                return None
+            await self._wait_for_data()
+
+    async def recv_chunk(self):
+        """
+        Wait for the next frame of a message, see Websocket.recv_chunk().
+        Returns None once the connection has closed.
+        """
+        while True:
+            chunk = super().recv_chunk()
+            await self._drain()  # any pongs or keepalive pings
+            if chunk or not self.open:
+                return chunk
+            await self._wait_for_data()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.recv()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def send(self, buf):
+        """Send a message, waiting until the socket has taken all of it."""
+        await self.send_many((buf,))
+
+    async def send_many(self, bufs):
+        """Send several messages with one write, see Websocket.send_many()."""
+        super().send_many(bufs)  # onto the send buffer
+        await self._drain()
+
+    async def wait_closed(self):
+        """
+        Close the websocket (if it isn't already), send the close frame and
+        close the socket.
+        """
+        self.close()
+        try:
+            await self._drain()
+        except OSError:
+            pass  # the link's already gone
+        await self.stream.wait_closed()
+
+
+async def connect(uri, max_message_size=None, deflate_wbits=None):
+    """
+    Connect a websocket. The arguments are the same as client.connect().
+    """
+    if protocol.deflate is None:
+        deflate_wbits = None
+
+    uri = urlparse(uri)
+    assert uri
+
+    if __debug__:
+        LOGGER.debug("open connection %s:%s", uri.hostname, uri.port)
+
+    # the same TLS settings as Connector, ssl=True would verify the certificate
+    if uri.protocol == "wss":
+        tls = client.ssl_context()
+    else:
+        tls = None
+    stream, _ = await asyncio.open_connection(
+        uri.hostname, uri.port, ssl=tls, server_hostname=uri.hostname
+    )
+
+    try:
+        stream.write(client.handshake_request(uri, deflate_wbits))
+        await stream.drain()
+
+        client.check_status_line((await stream.readline())[:-2])
+
+        accepted_wbits = None
+        header = (await stream.readline())[:-2]
+        while header:
+            accepted_wbits = client.parse_response_header(
+                header, deflate_wbits, accepted_wbits
+            )
+            header = (await stream.readline())[:-2]
+
+    except Exception:
+        stream.close()
+        raise
+
+    return AsyncWebsocket(stream, max_message_size, accepted_wbits)
@@ -11,6 +11,7 @@ import ubinascii as binascii
 import urandom as random
 import ssl
 
+from . import protocol
 from .protocol import Websocket, urlparse
 
 LOGGER = ulogging.getLogger(__name__)
@@ -20,10 +21,98 @@ class WebsocketClient(Websocket):
     is_client = True
 
 
-def connect(uri):
+def _accepted_deflate_wbits(extensions, wbits):
     """
-    Connect a websocket.
+    Return the window bits the server will compress with if its
+    Sec-WebSocket-Extensions header accepts our permessage-deflate offer,
+    otherwise None.
     """
+    params = [param.strip() for param in extensions.split(b";")]
+    if params[0] != b"permessage-deflate":
+        return None
+
+    # we decompress each message on its own, so the server can't refer back
+    # to earlier messages
+    assert (
+        b"server_no_context_takeover" in params
+    ), "Server didn't accept server_no_context_takeover"
+
+    for param in params:
+        if param.startswith(b"server_max_window_bits="):
+            wbits = min(wbits, int(param[23:].decode()))
+    return wbits
+
+
+def ssl_context():
+    """
+    The TLS settings for wss:// connections. The portal's certificate isn't
+    verified, the device has no CA certificates to check it against.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def handshake_request(uri, deflate_wbits=None):
+    """Return the HTTP request that asks the server to open a websocket."""
+    # Sec-WebSocket-Key is 16 bytes of random base64 encoded
+    key = binascii.b2a_base64(bytes(random.getrandbits(8) for _ in range(16)))[:-1]
+
+    headers = [
+        "GET %s HTTP/1.1" % (uri.path or "/"),
+        "Host: %s:%s" % (uri.hostname, uri.port),
+        "Connection: Upgrade",
+        "Upgrade: websocket",
+        "Sec-WebSocket-Key: %s" % key.decode(),
+        "Sec-WebSocket-Version: 13",
+        "Origin: http://{hostname}:{port}".format(hostname=uri.hostname, port=uri.port),
+    ]
+    if deflate_wbits:
+        # we never compress what we send, and each message is decompressed on
+        # its own so no window is kept in RAM between messages
+        headers.append(
+            "Sec-WebSocket-Extensions: permessage-deflate; "
+            "client_no_context_takeover; server_no_context_takeover; "
+            "server_max_window_bits=%d" % deflate_wbits
+        )
+
+    if __debug__:
+        for header in headers:
+            LOGGER.debug(header)
+    return ("\r\n".join(headers) + "\r\n\r\n").encode()
+
+
+def check_status_line(header):
+    assert header.startswith(
+        b"HTTP/1.1 101 "
+    ), "Invalid websocket header from server: " + str(header)
+
+
+def parse_response_header(header, deflate_wbits, accepted_wbits):
+    """
+    Check a header of the server's response. Returns the window bits the
+    server will compress with (accepted_wbits until the extensions header).
+    """
+    # We only need the extensions header
+    # FIXME: should we check the return key?
+    if __debug__:
+        LOGGER.debug(str(header))
+    split = header.find(b":")
+    if deflate_wbits and header[:split].lower() == b"sec-websocket-extensions":
+        return _accepted_deflate_wbits(header[split + 1 :].strip(), deflate_wbits)
+    return accepted_wbits
+
+
+def connect(uri, max_message_size=None, deflate_wbits=None):
+    """
+    Connect a websocket. See Websocket for max_message_size.
+
+    deflate_wbits - offer permessage-deflate with the server's window limited
+                    to 2^deflate_wbits bytes (9-15), if the firmware has the
+                    deflate module. None to not offer it.
+    """
+    if protocol.deflate is None:
+        deflate_wbits = None
 
     uri = urlparse(uri)
     assert uri
@@ -37,35 +126,14 @@ def connect(uri):
     if uri.protocol == "wss":
         sock = ssl.wrap_socket(sock)
 
-    def send_header(header, *args):
-        if __debug__:
-            LOGGER.debug(str(header), *args)
-        sock.write(header % args + "\r\n")
+    sock.write(handshake_request(uri, deflate_wbits))
 
-    # Sec-WebSocket-Key is 16 bytes of random base64 encoded
-    key = binascii.b2a_base64(bytes(random.getrandbits(8) for _ in range(16)))[:-1]
-
-    send_header(b"GET %s HTTP/1.1", uri.path or "/")
-    send_header(b"Host: %s:%s", uri.hostname, uri.port)
-    send_header(b"Connection: Upgrade")
-    send_header(b"Upgrade: websocket")
-    send_header(b"Sec-WebSocket-Key: %s", key)
-    send_header(b"Sec-WebSocket-Version: 13")
-    send_header(
-        b"Origin: http://{hostname}:{port}".format(hostname=uri.hostname, port=uri.port)
-    )
-    send_header(b"")
+    check_status_line(sock.readline()[:-2])
 
+    accepted_wbits = None
     header = sock.readline()[:-2]
-    assert header.startswith(
-        b"HTTP/1.1 101 "
-    ), "Invalid websocket header from server: " + str(header)
-
-    # We don't (currently) need these headers
-    # FIXME: should we check the return key?
     while header:
-        if __debug__:
-            LOGGER.debug(str(header))
+        accepted_wbits = parse_response_header(header, deflate_wbits, accepted_wbits)
         header = sock.readline()[:-2]
 
-    return WebsocketClient(sock)
+    return WebsocketClient(sock, max_message_size, accepted_wbits)
@@ -0,0 +1,256 @@
+"""
+Non-blocking websocket connections for micropython
+
+client.connect() blocks on the DNS lookup, the TCP connect, the TLS
+handshake and the websocket handshake. Connector does the same steps a
+little at a time each time poll() is called, so the caller's loop keeps
+running while it connects:
+
+    connector = Connector("wss://portal.example.com/ws/access")
+    while True:
+        websocket = connector.poll() or websocket
+        ...
+
+The address is cached so only the first attempt waits for DNS, and it's only
+looked up again after DNS_CACHE_MS or DNS_RETRY_FAILURES failed attempts in
+a row. Failed attempts are retried with an exponential
+backoff, and every attempt is delayed by a random amount so a building full
+of devices doesn't reconnect in lockstep when the server comes back. TLS
+sessions are resumed if the ssl module supports it.
+"""
+
+import ulogging
+import uerrno as errno
+import urandom as random
+import uselect as select
+import usocket as socket
+import utime as time
+
+from . import client
+from . import protocol
+from .client import WebsocketClient
+from .protocol import urlparse
+
+LOGGER = ulogging.getLogger(__name__)
+
+# Connector states
+_IDLE = const(0)  # waiting for the next attempt
+_TCP = const(1)  # waiting for the TCP connection
+_REQUEST = const(2)  # TLS handshake and sending the HTTP upgrade request
+_RESPONSE = const(3)  # reading the server's response headers
+
+DNS_CACHE_MS = const(3600000)  # look the server up again after an hour
+DNS_RETRY_FAILURES = const(3)  # or after this many failed attempts in a row
+MAX_RESPONSE_SIZE = const(4096)
+_RESPONSE_END = b"\r\n\r\n"  # a blank line ends the response headers
+
+
+def _jitter(delay_ms):
+    """A random delay between half and all of delay_ms."""
+    return random.randint(delay_ms // 2, delay_ms)
+
+
+class Connector:
+    def __init__(
+        self,
+        uri,
+        max_message_size=None,
+        deflate_wbits=None,
+        timeout_ms=10000,
+        min_backoff_ms=2000,
+        max_backoff_ms=60000,
+    ):
+        """
+        uri, max_message_size and deflate_wbits are as for client.connect().
+
+        timeout_ms     - give up on an attempt that takes longer than this
+        min_backoff_ms - the delay after the first failed attempt, which
+                         doubles with each failure up to max_backoff_ms.
+                         Attempts after a connection drops are spread over
+                         0 to min_backoff_ms.
+        """
+        self.uri = urlparse(uri)
+        assert self.uri
+        self.max_message_size = max_message_size
+        self.deflate_wbits = None if protocol.deflate is None else deflate_wbits
+        self.timeout_ms = timeout_ms
+        self.min_backoff_ms = min_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+
+        self.failures = 0  # attempts failed in a row
+        self._state = _IDLE
+        self._next_attempt = None  # ticks_ms of the next attempt
+        self._deadline = None
+        self._sock = None
+        self._poller = None
+        self._request = None
+        self._sent = 0
+        self._response = bytearray()
+        self._matched = 0  # bytes seen of the blank line ending the response
+        self._byte = bytearray(1)
+
+        self._addr = None
+        self._addr_time = None
+        self._ssl_context = None
+        self._tls_session = None
+
+    @property
+    def connecting(self):
+        """True while an attempt is in progress."""
+        return self._state != _IDLE
+
+    def poll(self):
+        """
+        Do the next step of connecting without blocking (except on a DNS
+        lookup that isn't cached). Returns the WebsocketClient once it's
+        connected, otherwise None. Raises the error if an attempt fails, the
+        next one is scheduled first.
+        """
+        now = time.ticks_ms()
+
+        if self._state == _IDLE:
+            if self._next_attempt is None:
+                self._next_attempt = time.ticks_add(
+                    now, random.randint(0, self.min_backoff_ms)
+                )
+            if time.ticks_diff(now, self._next_attempt) < 0:
+                return None
+
+        try:
+            if self._state == _IDLE:
+                self._start(now)
+            elif time.ticks_diff(now, self._deadline) > 0:
+                raise OSError(errno.ETIMEDOUT)
+            return self._step()
+        except Exception:
+            self._fail(now)
+            raise
+
+    def _resolve(self, now):
+        if self._addr is None or time.ticks_diff(now, self._addr_time) > DNS_CACHE_MS:
+            if __debug__:
+                LOGGER.debug("resolving %s", self.uri.hostname)
+            self._addr = socket.getaddrinfo(self.uri.hostname, self.uri.port)[0][-1]
+            self._addr_time = now
+        return self._addr
+
+    def _start(self, now):
+        if __debug__:
+            LOGGER.debug("open connection %s:%s", self.uri.hostname, self.uri.port)
+        addr = self._resolve(now)
+        self._deadline = time.ticks_add(time.ticks_ms(), self.timeout_ms)
+
+        self._sock = socket.socket()
+        self._sock.setblocking(False)
+        try:
+            self._sock.connect(addr)
+        except OSError as e:
+            if e.errno != errno.EINPROGRESS:
+                raise
+
+        self._poller = select.poll()
+        self._poller.register(self._sock, select.POLLOUT)
+        self._state = _TCP
+
+    def _wrap_tls(self):
+        if self._ssl_context is None:
+            self._ssl_context = client.ssl_context()
+
+        kwargs = {
+            "server_hostname": self.uri.hostname,
+            "do_handshake_on_connect": False,  # done by the non-blocking writes
+        }
+        if self._tls_session is not None:
+            kwargs["session"] = self._tls_session
+        self._sock = self._ssl_context.wrap_socket(self._sock, **kwargs)
+
+    def _step(self):
+        if self._state == _TCP:
+            events = self._poller.poll(0)
+            if not events:
+                return None
+            if events[0][1] & (select.POLLERR | select.POLLHUP):
+                raise OSError(errno.ECONNREFUSED)
+
+            self._poller = None
+            if self.uri.protocol == "wss":
+                self._wrap_tls()
+            self._request = memoryview(
+                client.handshake_request(self.uri, self.deflate_wbits)
+            )
+            self._sent = 0
+            self._state = _REQUEST
+
+        if self._state == _REQUEST:
+            # writes return None until the TLS handshake is done
+            while self._sent < len(self._request):
+                count = self._sock.write(self._request[self._sent :])
+                if not count:
+                    return None
+                self._sent += count
+            self._response = bytearray()
+            self._matched = 0
+            self._state = _RESPONSE
+
+        # read a byte at a time so nothing after the headers is taken
+        while self._matched < 4:
+            count = self._sock.readinto(self._byte)
+            if count is None:
+                return None
+            if not count:
+                raise OSError(errno.ECONNRESET)
+
+            byte = self._byte[0]
+            self._response.append(byte)
+            if byte == _RESPONSE_END[self._matched]:
+                self._matched += 1
+            else:
+                self._matched = 1 if byte == _RESPONSE_END[0] else 0
+
+            if len(self._response) > MAX_RESPONSE_SIZE:
+                raise ValueError("Websocket handshake response too long")
+
+        return self._connected()
+
+    def _connected(self):
+        lines = bytes(self._response).split(b"\r\n")
+        client.check_status_line(lines[0])
+
+        accepted_wbits = None
+        for header in lines[1:]:
+            if header:
+                accepted_wbits = client.parse_response_header(
+                    header, self.deflate_wbits, accepted_wbits
+                )
+
+        websocket = WebsocketClient(self._sock, self.max_message_size, accepted_wbits)
+        self._tls_session = getattr(self._sock, "session", None)
+        self._sock = None
+        self._response = bytearray()
+        self._state = _IDLE
+        self._next_attempt = None  # spread out the reconnect if it drops
+        self.failures = 0
+        return websocket
+
+    def _fail(self, now):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._poller = None
+        self._state = _IDLE
+        self._tls_session = None
+
+        self.failures += 1
+        if self.failures % DNS_RETRY_FAILURES == 0:
+            # the server may have moved, look it up again next time
+            self._addr = None
+
+        backoff = min(
+            self.min_backoff_ms << min(self.failures - 1, 16), self.max_backoff_ms
+        )
+        delay = _jitter(backoff)
+        self._next_attempt = time.ticks_add(now, delay)
+        LOGGER.debug("attempt %s failed, retrying in %s ms", self.failures, delay)
@@ -3,12 +3,19 @@ Websockets protocol
 """
 
 import ulogging
+import uio as io
 import ure as re
 import ustruct as struct
 import urandom as random
 import usocket as socket
+import utime as time
 from ucollections import namedtuple
 
+try:
+    import deflate
+except ImportError:
+    deflate = None  # permessage-deflate isn't offered without it
+
 LOGGER = ulogging.getLogger(__name__)
 
 # Opcodes
@@ -30,6 +37,32 @@ CLOSE_TOO_BIG = const(1009)
 CLOSE_MISSING_EXTN = const(1010)
 CLOSE_BAD_CONDITION = const(1011)
 
+# Payloads are masked this many bytes at a time (a multiple of 4 so the
+# mask lines up with the start of every chunk)
+MASK_CHUNK = const(512)
+
+# The buffers incoming frames are read (and fragments joined) into grow in
+# steps of this many bytes
+FRAME_BUF_STEP = const(512)
+
+# What read_frame is waiting for
+_RX_HEADER = const(0)
+_RX_LENGTH = const(1)  # the extended payload length
+_RX_MASK = const(2)
+_RX_PAYLOAD = const(3)
+_RX_STREAM = const(4)  # handing the payload over a piece at a time
+
+# Uncompressed frames are handed to recv_chunk at most this many bytes at a
+# time, so a big frame doesn't have to fit in RAM
+STREAM_CHUNK = const(2048)
+
+# Compressed messages are decompressed this many bytes at a time by recv_chunk
+INFLATE_CHUNK = const(2048)
+
+# permessage-deflate strips the empty stored block that ends each message.
+# Put it back, followed by an empty final block so the stream ends cleanly.
+DEFLATE_TAIL = b'\x00\x00\xff\xff\x01\x00\x00\xff\xff'
+
 URL_RE = re.compile(r'(wss|ws)://([A-Za-z0-9-\.]+)(?:\:([0-9]+))?(/.+)?')
 URI = namedtuple('URI', ('protocol', 'hostname', 'port', 'path'))
 
@@ -63,6 +96,31 @@ def urlparse(uri):
         return URI(protocol, host, int(port), path)
 
 
+def _buffer_size(length):
+    # round up so a run of slightly bigger frames doesn't regrow each time
+    return (length + FRAME_BUF_STEP - 1) // FRAME_BUF_STEP * FRAME_BUF_STEP
+
+
+def _mask_python(buf, length, mask_bits):
+    """XOR buf[:length] in place with the 4 byte mask."""
+    # XOR as big ints, which is much faster than a byte at a time
+    key = int.from_bytes(bytes(mask_bits) * (MASK_CHUNK // 4), 'little')
+    for start in range(0, length, MASK_CHUNK):
+        end = min(start + MASK_CHUNK, length)
+        chunk = int.from_bytes(memoryview(buf)[start:end], 'little')
+        if end - start < MASK_CHUNK:
+            key &= (1 << ((end - start) * 8)) - 1
+        buf[start:end] = (chunk ^ key).to_bytes(end - start, 'little')
+
+
+try:
+    from .viper_mask import mask as apply_mask
+    # off the device micropython.viper may be a stub that can't run this
+    apply_mask(bytearray(5), 5, b'\x00\x00\x00\x00')
+except (ImportError, SyntaxError, NameError):
+    apply_mask = _mask_python
+
+
 class Websocket:
     """
     Basis of the Websocket protocol.
@@ -72,10 +130,62 @@ class Websocket:
     """
     is_client = False
 
-    def __init__(self, sock):
+    def __init__(self, sock, max_message_size=None, deflate_wbits=None):
+        """
+        max_message_size - the largest frame, or message reassembled from
+                           fragments, to buffer whole in bytes (None for no
+                           limit). Bigger ones close the connection with
+                           CLOSE_TOO_BIG. Frames recv_chunk() streams aren't
+                           buffered whole, so they aren't limited.
+        deflate_wbits    - the window bits negotiated for permessage-deflate,
+                           or None if it wasn't negotiated.
+        """
         self.sock = sock
         self.open = True
+        self.max_message_size = max_message_size
+        self.deflate_wbits = deflate_wbits
         self.sock.setblocking(False)
+        self._mask_buf = bytearray(MASK_CHUNK)
+        self._mask_view = memoryview(self._mask_buf)
+        self._header_view = memoryview(bytearray(12))
+        # read_frame picks up where it left off if a frame arrives in pieces
+        self._rx_state = _RX_HEADER
+        self._rx_view = self._header_view[:2]
+        self._rx_got = 0
+        self._rx_fin = True
+        self._rx_opcode = OP_CONT
+        self._rx_mask = False
+        self._rx_length = 0
+        self._rx_left = 0  # payload bytes of a streamed frame still to come
+        self._rx_offset = 0  # payload bytes of a streamed frame handed over
+        self._frame_buf = bytearray(FRAME_BUF_STEP)
+        self._frame_view = memoryview(self._frame_buf)
+        self._message_buf = bytearray()  # fragmented messages are joined here
+        self._message_view = memoryview(self._message_buf)
+        self._message_len = 0
+        self._message_opcode = None  # set while a fragmented message arrives
+        self._message_compressed = False
+        self._frame_compressed = False  # RSV1 of the last frame read
+        self._inflater = None  # decompresses a message for recv_chunk
+        # frames the socket hasn't taken yet, see flush()
+        self._tx_buf = None
+        self._tx_sent = 0
+        # keepalive pings, see keepalive()
+        self.ping_interval = None
+        self.ping_timeout = None
+        self._ping_seq = 0
+        self._ping_sent = None  # when the unanswered ping was sent
+        self._last_ping = time.ticks_ms()
+        # round trip times of the keepalive pings in ms
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.rtt_last = None
+        self.rtt_min = None
+        self.rtt_max = None
+        self.rtt_avg = None
+        if deflate_wbits:
+            self._inflate_buf = bytearray(INFLATE_CHUNK)
+            self._inflate_view = memoryview(self._inflate_buf)
 
     def __enter__(self):
         return self
@@ -86,57 +196,202 @@ class Websocket:
     def settimeout(self, timeout):
         self.sock.settimeout(timeout)
 
-    def read_frame(self, max_size=None):
+    def read_frame(self, max_size=None, stream=False):
         """
         Read a frame from the socket.
         See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
-        """
 
-        # Frame header
-        two_bytes = self.sock.read(2)
+        The socket is non-blocking, so a frame can arrive over several calls.
+        Whatever has arrived is kept and NoDataException is raised until the
+        rest of the frame is in.
 
-        if not two_bytes:
-            raise NoDataException
-
-        byte1, byte2 = struct.unpack('!BB', two_bytes)
+        The payload is returned as a memoryview of a buffer that's reused for
+        the next frame, so copy it if it needs to outlive the next read.
 
-        # Byte 1: FIN(1) _(1) _(1) _(1) OPCODE(4)
-        fin = bool(byte1 & 0x80)
-        opcode = byte1 & 0x0f
-
-        # Byte 2: MASK(1) LENGTH(7)
-        mask = bool(byte2 & (1 << 7))
-        length = byte2 & 0x7f
-
-        if length == 126:  # Magic number, length header is 2 bytes
-            length, = struct.unpack('!H', self.sock.read(2))
-        elif length == 127:  # Magic number, length header is 8 bytes
-            length, = struct.unpack('!Q', self.sock.read(8))
-
-        if mask:  # Mask is 4 bytes
-            mask_bits = self.sock.read(4)
+        With stream=True the payload of an uncompressed data frame is handed
+        over as it arrives, up to STREAM_CHUNK bytes at a time, as if the
+        frame had been split into fragments: the pieces after the first come
+        back as OP_CONT, and only the last has the frame's FIN. Streamed
+        frames aren't limited by max_size, the other frames (which are
+        buffered whole) are.
+        """
+        header = self._header_view
+
+        while True:
+            if self._rx_state == _RX_STREAM:
+                return self._read_piece()
+
+            if not self._fill_rx_view():
+                raise NoDataException
+
+            state = self._rx_state
+
+            if state == _RX_HEADER:
+                byte1 = header[0]
+                byte2 = header[1]
+
+                # Byte 1: FIN(1) RSV1(1) _(1) _(1) OPCODE(4)
+                self._rx_fin = bool(byte1 & 0x80)
+                # set by permessage-deflate
+                self._frame_compressed = bool(byte1 & 0x40)
+                self._rx_opcode = byte1 & 0x0f
+
+                # Byte 2: MASK(1) LENGTH(7)
+                self._rx_mask = bool(byte2 & (1 << 7))
+                length = byte2 & 0x7f
+
+                if length == 126:  # Magic number, length header is 2 bytes
+                    self._expect(_RX_LENGTH, header[:2])
+                    continue
+                elif length == 127:  # Magic number, length header is 8 bytes
+                    self._expect(_RX_LENGTH, header[:8])
+                    continue
+
+            elif state == _RX_LENGTH:
+                if len(self._rx_view) == 2:
+                    length, = struct.unpack_from('!H', header)
+                else:
+                    length, = struct.unpack_from('!Q', header)
+
+            elif state == _RX_PAYLOAD:
+                data = self._rx_view
+                self._expect(_RX_HEADER, header[:2])
+                if self._rx_mask:
+                    apply_mask(self._frame_buf, len(data), header[8:12])
+                return self._rx_fin, self._rx_opcode, data
+
+            if state != _RX_MASK:
+                self._rx_length = length
+                if self._rx_mask:  # Mask is 4 bytes
+                    self._expect(_RX_MASK, header[8:12])
+                    continue
+
+            # the header is complete, get ready for the payload
+            length = self._rx_length
+
+            if stream and self._streamable():
+                self._rx_left = length
+                self._rx_offset = 0
+                if len(self._frame_buf) < STREAM_CHUNK:
+                    self._grow_frame_buf(STREAM_CHUNK)
+                self._expect_piece()
+                continue
 
-        try:
-            data = self.sock.read(length)
-        except MemoryError:
-            # We can't receive this many bytes, close the socket
-            if __debug__:
-                LOGGER.debug("Frame of length %s too big. Closing",
-                             length)
-            self.close(code=CLOSE_TOO_BIG)
-            return True, OP_CLOSE, None
+            if max_size is not None and length > max_size:
+                if __debug__:
+                    LOGGER.debug("Frame of length %s too big. Closing",
+                                 length)
+                self.close(code=CLOSE_TOO_BIG)
+                return True, OP_CLOSE, None
+
+            if length > len(self._frame_buf):
+                try:
+                    self._grow_frame_buf(length)
+                except MemoryError:
+                    # We can't receive this many bytes, close the socket
+                    if __debug__:
+                        LOGGER.debug("Frame of length %s too big. Closing",
+                                     length)
+                    self.close(code=CLOSE_TOO_BIG)
+                    return True, OP_CLOSE, None
+
+            self._expect(_RX_PAYLOAD, self._frame_view[:length])
+
+    def _streamable(self):
+        """True if the frame whose header was just read can be streamed."""
+        opcode = self._rx_opcode
+        if opcode == OP_CONT:
+            return self._message_opcode is not None and (
+                not self._message_compressed)
+        if opcode == OP_TEXT or opcode == OP_BYTES:
+            return not (self._frame_compressed and self.deflate_wbits)
+        return False  # control frames are small, and answered whole
+
+    def _expect_piece(self):
+        """Get ready to read the next piece of a streamed payload."""
+        self._expect(_RX_STREAM,
+                     self._frame_view[:min(self._rx_left, STREAM_CHUNK)])
+
+    def _read_piece(self):
+        """
+        Return (fin, opcode, payload) for the next piece of a streamed
+        payload, as much of it as has arrived.
+        """
+        view = self._rx_view
+        while self._rx_got < len(view):
+            count = self.sock.readinto(view[self._rx_got:])
+            if count is None:
+                break  # hand over what we've got so far
+            if not count:
+                raise ValueError('Connection closed mid frame')
+            self._rx_got += count
+
+        got = self._rx_got
+        if not got and len(view):
+            raise NoDataException
 
-        if mask:
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+        if self._rx_mask:
+            # line the mask up with where this piece starts in the payload
+            shift = self._rx_offset % 4
+            mask = self._header_view[8:12]
+            apply_mask(self._frame_buf, got,
+                       bytes(mask[shift:]) + bytes(mask[:shift]))
+
+        opcode = OP_CONT if self._rx_offset else self._rx_opcode
+        self._rx_offset += got
+        self._rx_left -= got
+        fin = self._rx_fin and not self._rx_left
+        if self._rx_left:
+            self._expect_piece()
+        else:
+            self._expect(_RX_HEADER, self._header_view[:2])
+        return fin, opcode, view[:got]
 
-        return fin, opcode, data
+    def _expect(self, state, view):
+        """Move to the next part of the frame, which will be read into view."""
+        self._rx_state = state
+        self._rx_view = view
+        self._rx_got = 0
 
-    def write_frame(self, opcode, data=b''):
+    def _fill_rx_view(self):
+        """
+        Read into _rx_view until it's full. Returns False if the socket runs
+        out of data first, the rest is read on the next call.
         """
-        Write a frame to the socket.
+        view = self._rx_view
+        while self._rx_got < len(view):
+            count = self.sock.readinto(view[self._rx_got:])
+            if count is None:
+                return False  # nothing buffered on the non-blocking socket
+            if not count:
+                if self._rx_state == _RX_HEADER and not self._rx_got:
+                    return False
+                raise ValueError('Connection closed mid frame')
+            self._rx_got += count
+        return True
+
+    def _grow_frame_buf(self, length):
+        # free the old buffer first, it doesn't hold anything we need
+        self._frame_buf = None
+        self._frame_view = None
+        self._frame_buf = bytearray(_buffer_size(length))
+        self._frame_view = memoryview(self._frame_buf)
+
+    def write_frame(self, opcode, data=b'', write=None):
+        """
+        Write a frame to the socket, or pass it to write() a piece at a time.
         See https://tools.ietf.org/html/rfc6455#section-5.2 for the details.
+
+        Without write() the whole frame is added to the send buffer, after
+        anything still waiting there so frames don't interleave, and flushed.
+        Returns True if it's all been written, otherwise flush() sends the
+        rest later.
         """
+        queued = write is None
+        if queued:
+            if self._tx_buf is None:
+                self._tx_buf = bytearray()
+            write = self._tx_buf.extend
         fin = True
         mask = self.is_client  # messages sent by client are masked
 
@@ -152,27 +407,38 @@ class Websocket:
 
         if length < 126:  # 126 is magic value to use 2-byte length header
             byte2 |= length
-            self.sock.write(struct.pack('!BB', byte1, byte2))
+            write(struct.pack('!BB', byte1, byte2))
 
         elif length < (1 << 16):  # Length fits in 2-bytes
             byte2 |= 126  # Magic code
-            self.sock.write(struct.pack('!BBH', byte1, byte2, length))
+            write(struct.pack('!BBH', byte1, byte2, length))
 
         elif length < (1 << 64):
             byte2 |= 127  # Magic code
-            self.sock.write(struct.pack('!BBQ', byte1, byte2, length))
+            write(struct.pack('!BBQ', byte1, byte2, length))
 
         else:
             raise ValueError()
 
         if mask:  # Mask is 4 bytes
             mask_bits = struct.pack('!I', random.getrandbits(32))
-            self.sock.write(mask_bits)
+            write(mask_bits)
+            self._write_masked(data, length, mask_bits, write)
+        else:
+            write(data)
 
-            data = bytes(b ^ mask_bits[i % 4]
-                         for i, b in enumerate(data))
+        if queued:
+            return self.flush()
 
-        self.sock.write(data)
+    def _write_masked(self, data, length, mask_bits, write):
+        """Mask and write the payload a chunk at a time through _mask_buf."""
+        buf = self._mask_buf
+        view = memoryview(data)
+        for start in range(0, length, MASK_CHUNK):
+            size = min(MASK_CHUNK, length - start)
+            buf[:size] = view[start:start + size]
+            apply_mask(buf, size, mask_bits)
+            write(self._mask_view[:size])
 
     def recv(self):
         """
@@ -183,30 +449,196 @@ class Websocket:
         If you don't call recv() sufficiently often you won't process control
         frames.
         """
+        opcode, data = self._recv_message()
+
+        if opcode == OP_TEXT:
+            return str(data, 'utf-8')
+        elif opcode == OP_BYTES:
+            return bytes(data)
+        elif opcode == OP_CLOSE:
+            return
+        return ''
+
+    def recv_view(self):
+        """
+        Like recv(), but return the payload of a text or binary message as a
+        memoryview without copying or decoding it. The view is only valid
+        until the next call. Returns None if there's nothing to read or the
+        connection closed.
+        """
+        opcode, data = self._recv_message()
+        return data if opcode in (OP_TEXT, OP_BYTES) else None
+
+    def recv_chunk(self):
+        """
+        Receive the next frame of a text or binary message without
+        reassembling fragmented messages. Returns (payload, fin), where fin
+        is True for the last frame of the message and payload is a
+        memoryview that's only valid until the next call. Returns None if
+        there's nothing to read or the connection closed.
+
+        Uncompressed frames are returned as they arrive, up to STREAM_CHUNK
+        bytes at a time, so a big frame comes back in several pieces with fin
+        only on the last. They aren't limited by max_message_size.
+
+        Compressed messages are joined while still compressed, then returned
+        INFLATE_CHUNK bytes at a time (the last chunk may be empty).
+
+        Don't mix this with recv() in the middle of a fragmented message.
+        """
+        while self._inflater is None:
+            opcode, data, fin = self._recv_data_frame(stream=True)
+            if data is None:
+                return None
+            if not self._message_compressed:
+                return data, fin
+
+            data = self._join_fragment(data, fin, DEFLATE_TAIL)
+            if not self.open:
+                return None
+            if data is not None:
+                self._inflater = self._new_inflater(data)
+
+        count = self._inflater.readinto(self._inflate_view[:INFLATE_CHUNK])
+        if count:
+            return self._inflate_view[:count], False
+        self._inflater = None
+        return self._inflate_view[:0], True
+
+    def _recv_message(self):
+        """Return (opcode, payload) of the next complete message."""
+        while True:
+            opcode, data, fin = self._recv_data_frame()
+            if data is None:
+                return opcode, None
+
+            if self._message_compressed:
+                data = self._join_fragment(data, fin, DEFLATE_TAIL)
+                if data is not None:
+                    data = self._inflate(data)
+            elif fin and not self._message_len:
+                return opcode, data  # not fragmented, no need to copy it
+            else:
+                data = self._join_fragment(data, fin)
+
+            if not self.open:
+                return OP_CLOSE, None
+            if data is not None:
+                return opcode, data
+
+    def _join_fragment(self, data, fin, tail=b''):
+        """
+        Add a frame to the message being joined in _message_buf. After the
+        last frame return a view of the whole message followed by tail,
+        otherwise None. Closes the connection if the message is too big.
+        """
+        end = self._message_len + len(data)
+        if self.max_message_size is not None and end > self.max_message_size:
+            if __debug__:
+                LOGGER.debug("Message of length %s too big. Closing", end)
+            self.close(code=CLOSE_TOO_BIG)
+            return None
+
+        if end + len(tail) > len(self._message_buf):
+            try:
+                buf = bytearray(_buffer_size(end + len(tail)))
+            except MemoryError:
+                if __debug__:
+                    LOGGER.debug("Message of length %s too big. Closing", end)
+                self.close(code=CLOSE_TOO_BIG)
+                return None
+            buf[:self._message_len] = self._message_view[:self._message_len]
+            self._message_buf = buf
+            self._message_view = memoryview(buf)
+        self._message_view[self._message_len:end] = data
+
+        if not fin:
+            self._message_len = end
+            return None
+
+        self._message_len = 0
+        self._message_view[end:end + len(tail)] = tail
+        return self._message_view[:end + len(tail)]
+
+    def _new_inflater(self, data):
+        """Return a stream that decompresses a message joined with DEFLATE_TAIL."""
+        return deflate.DeflateIO(io.BytesIO(data), deflate.RAW,
+                                 self.deflate_wbits)
+
+    def _inflate(self, data):
+        """
+        Decompress a whole message into _inflate_buf, which grows to fit it.
+        Closes the connection and returns None if it's too big.
+        """
+        inflater = self._new_inflater(data)
+        length = 0
+        while True:
+            if length == len(self._inflate_buf):
+                buf = bytearray(length * 2)
+                buf[:length] = self._inflate_view
+                self._inflate_buf = buf
+                self._inflate_view = memoryview(buf)
+
+            count = inflater.readinto(self._inflate_view[length:])
+            if not count:
+                return self._inflate_view[:length]
+            length += count
+
+            if self.max_message_size is not None and (
+                    length > self.max_message_size):
+                if __debug__:
+                    LOGGER.debug("Message inflates to over %s. Closing",
+                                 length)
+                self.close(code=CLOSE_TOO_BIG)
+                return None
+
+    def _recv_data_frame(self, stream=False):
+        """
+        Return (opcode, payload, fin) of the next frame of a text or binary
+        message, answering any control frames on the way. opcode is the
+        message's opcode, including for its continuation frames. Returns
+        (None, None, True) if there's nothing to read, or (OP_CLOSE, None,
+        True) once the connection is closed. With stream=True, uncompressed
+        frames are returned a piece at a time, see read_frame().
+        """
         assert self.open
 
+        if self.ping_interval and not self._check_keepalive():
+            return OP_CLOSE, None, True
+
         while self.open:
             try:
-                fin, opcode, data = self.read_frame()
+                fin, opcode, data = self.read_frame(self.max_message_size,
+                                                    stream)
             except NoDataException:
-                return ''
+                return None, None, True
             except ValueError:
                 LOGGER.debug("Failed to read frame. Socket dead.")
                 self._close()
                 raise ConnectionClosed()
 
-            if not fin:
-                raise NotImplementedError()
-
-            if opcode == OP_TEXT:
-                return data.decode('utf-8')
-            elif opcode == OP_BYTES:
-                return data
+            if opcode == OP_TEXT or opcode == OP_BYTES:
+                if self._message_opcode is not None:
+                    break  # the last message wasn't finished
+                if not fin:
+                    self._message_opcode = opcode
+                self._message_compressed = (
+                    self._frame_compressed and bool(self.deflate_wbits))
+                return opcode, data, fin
+            elif opcode == OP_CONT:
+                # This is a continuation of a previous frame
+                if self._message_opcode is None:
+                    break
+                opcode = self._message_opcode
+                if fin:
+                    self._message_opcode = None
+                return opcode, data, fin
             elif opcode == OP_CLOSE:
                 self._close()
-                return
+                return OP_CLOSE, None, True
             elif opcode == OP_PONG:
-                # Ignore this frame, keep waiting for a data frame
+                self._pong_received(data)
+                # And then keep waiting for a data frame
                 continue
             elif opcode == OP_PING:
                 # We need to send a pong frame
@@ -215,27 +647,132 @@ class Websocket:
                 self.write_frame(OP_PONG, data)
                 # And then wait to receive
                 continue
-            elif opcode == OP_CONT:
-                # This is a continuation of a previous frame
-                raise NotImplementedError(opcode)
             else:
                 raise ValueError(opcode)
+        else:
+            return OP_CLOSE, None, True
+
+        if __debug__:
+            LOGGER.debug("Unexpected frame fragment. Closing")
+        self.close(code=CLOSE_PROTOCOL_ERROR)
+        return OP_CLOSE, None, True
+
+    def keepalive(self, interval_ms, timeout_ms):
+        """
+        Send a ping every interval_ms while receiving, and close the connection
+        if its pong hasn't come back within timeout_ms. The round trip times
+        are kept in the rtt_* attributes, see rtt_stats().
+        """
+        self.ping_interval = interval_ms
+        self.ping_timeout = timeout_ms
+
+    def _check_keepalive(self):
+        """Send a ping if one's due. Returns False if the link timed out."""
+        now = time.ticks_ms()
+
+        if self._ping_sent is not None:
+            if time.ticks_diff(now, self._ping_sent) > self.ping_timeout:
+                LOGGER.debug("No pong in %s ms. Socket dead.", self.ping_timeout)
+                self._close()
+                return False
+
+        elif time.ticks_diff(now, self._last_ping) >= self.ping_interval:
+            self._ping_seq = (self._ping_seq + 1) & 0xffffffff
+            self.write_frame(OP_PING, struct.pack('!I', self._ping_seq))
+            self._ping_sent = now
+            self._last_ping = now
+            self.pings_sent += 1
+
+        return True
+
+    def _pong_received(self, data):
+        # pongs that don't answer our last ping are unsolicited, ignore them
+        if self._ping_sent is None or len(data) != 4:
+            return
+        if struct.unpack_from('!I', data)[0] != self._ping_seq:
+            return
+
+        rtt = time.ticks_diff(time.ticks_ms(), self._ping_sent)
+        self._ping_sent = None
+        self.pongs_received += 1
+
+        self.rtt_last = rtt
+        if self.rtt_avg is None:
+            self.rtt_min = self.rtt_max = self.rtt_avg = rtt
+        else:
+            self.rtt_min = min(self.rtt_min, rtt)
+            self.rtt_max = max(self.rtt_max, rtt)
+            # moving average, like TCP's smoothed RTT
+            self.rtt_avg += (rtt - self.rtt_avg) // 8
+
+    def rtt_stats(self):
+        """Return the keepalive round trip times (ms) as a dict."""
+        return {
+            "last": self.rtt_last,
+            "min": self.rtt_min,
+            "max": self.rtt_max,
+            "avg": self.rtt_avg,
+            "pings": self.pings_sent,
+            "pongs": self.pongs_received,
+        }
 
     def send(self, buf):
-        """Send data to the websocket."""
+        """
+        Send data to the websocket. Returns True if it's all been written,
+        otherwise flush() sends the rest later.
+        """
 
         assert self.open
 
+        return self.write_frame(*self._message_frame(buf))
+
+    def send_many(self, bufs):
+        """
+        Send several messages with a single socket write, so they share TCP
+        segments (and TLS records) instead of taking a write each.
+
+        Whatever the non-blocking socket doesn't take is kept and sent by
+        flush(). Returns True if the whole batch was written.
+        """
+
+        assert self.open
+
+        batch = self._tx_buf if self._tx_buf is not None else bytearray()
+        for buf in bufs:
+            opcode, buf = self._message_frame(buf)
+            self.write_frame(opcode, buf, batch.extend)
+        self._tx_buf = batch
+        return self.flush()
+
+    def flush(self):
+        """
+        Write the frames waiting in the send buffer, as much as the socket
+        will take. Returns True once nothing is waiting to be sent.
+        """
+        batch = self._tx_buf
+        if batch is None:
+            return True
+
+        while self._tx_sent < len(batch):
+            count = self.sock.write(memoryview(batch)[self._tx_sent:])
+            if not count:
+                return False  # the socket's buffer is full, try again later
+            self._tx_sent += count
+
+        self._tx_buf = None
+        self._tx_sent = 0
+        return True
+
+    @staticmethod
+    def _message_frame(buf):
+        """Return the opcode and payload to send buf as a message."""
         if isinstance(buf, str):
-            opcode = OP_TEXT
-            buf = buf.encode('utf-8')
+            return OP_TEXT, buf.encode('utf-8')
         elif isinstance(buf, bytes):
-            opcode = OP_BYTES
+            return OP_BYTES, buf
         else:
             raise TypeError()
 
-        self.write_frame(opcode, buf)
-
     def close(self, code=CLOSE_OK, reason=''):
         """Close the websocket."""
         if not self.open:
@@ -243,8 +780,10 @@ class Websocket:
 
         buf = struct.pack('!H', code) + reason.encode('utf-8')
 
-        self.write_frame(OP_CLOSE, buf)
-        self._close()
+        try:
+            self.write_frame(OP_CLOSE, buf)
+        finally:
+            self._close()  # free the socket even if the link's gone
 
     def _close(self):
         if __debug__:
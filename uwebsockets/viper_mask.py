@@ -0,0 +1,31 @@
+"""
+Websocket masking compiled with the viper emitter.
+
+This is a separate module because ports without viper refuse to compile the
+whole file. protocol.py falls back to a pure python version if it can't be
+imported.
+"""
+
+import micropython
+
+
+@micropython.viper
+def mask(buf, length: int, mask_bits):
+    """XOR buf[:length] in place with the 4 byte mask, a word at a time."""
+    key = ptr8(mask_bits)
+    # the esp32 is little endian, so byte n of each word lines up with key[n]
+    word = int(key[0]) | (int(key[1]) << 8) | (int(key[2]) << 16) | (int(key[3]) << 24)
+
+    # bytearrays live on the gc heap, which is word aligned
+    words = ptr32(buf)
+    count = length >> 2
+    i = 0
+    while i < count:
+        words[i] = int(words[i]) ^ word
+        i += 1
+
+    data = ptr8(buf)
+    i = count << 2
+    while i < length:
+        data[i] = int(data[i]) ^ int(key[i & 3])
+        i += 1
@@ -7,6 +7,7 @@ uweigand.py - read card IDs from a wiegand card reader
 """
 
 from machine import Pin, Timer
+from array import array
 import utime
 
 # The common Wiegand standard use 26 bits
@@ -24,9 +25,21 @@ MIFARE_MASK = 0b0_11111111_11111111_11111111_11111111_0  # all 4 bytes (32 bits)
 # Max pulse interval: 2ms
 # pulse width: 50us
 
+# Cards read but not yet taken with read_card(). The buffer is allocated up
+# front since it's filled from the timer callback.
+EVENT_BUFFER_SIZE = 16
+
 
 class Wiegand:
-    def __init__(self, pin0, pin1, callback=None, timer_id=-1, uid_32bit_mode=False):
+    def __init__(
+        self,
+        pin0,
+        pin1,
+        callback=None,
+        timer_id=-1,
+        uid_32bit_mode=False,
+        buffer_size=EVENT_BUFFER_SIZE,
+    ):
         """
         pin0 - the GPIO that goes high when a zero is sent by the reader
         pin1 - the GPIO that goes high when a one is sent by the reader
@@ -36,6 +49,8 @@ class Wiegand:
         timer_id - the Timer ID to use for periodic callbacks
         uid_32bit_mode - if True read_card() returns full 32bit mifare code, otherwise
                          if False read_card() returns only 24bit mifare code
+        buffer_size - how many cards to hold until they're read. Cards read
+                      while it's full are dropped and counted in cards_dropped
         """
         self._pin0 = Pin(pin0, Pin.IN, Pin.PULL_UP)
         self._pin1 = Pin(pin1, Pin.IN, Pin.PULL_UP)
@@ -43,13 +58,23 @@ class Wiegand:
         self._last_card = None
         self._next_card = 0
         self._bits = 0
+        self.cards_read = 0
+        self._uid_32bit_mode = uid_32bit_mode
+
+        # a ring buffer of (card UID, ticks_ms) events. The timer callback
+        # only moves _event_head and read_event() only moves _event_tail, so
+        # neither has to lock out the other. One slot is always left empty.
+        self._event_uids = array("L", [0] * (buffer_size + 1))
+        self._event_times = array("L", [0] * (buffer_size + 1))
+        self._event_head = 0
+        self._event_tail = 0
+        self.cards_dropped = 0
+
         self._pin0.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin0)
         self._pin1.irq(trigger=Pin.IRQ_FALLING, handler=self._on_pin1)
         self._last_bit_read = None
         self._timer = Timer(timer_id)
         self._timer.init(period=50, mode=Timer.PERIODIC, callback=self._cardcheck)
-        self.cards_read = 0
-        self._uid_32bit_mode = uid_32bit_mode
 
     def _on_pin0(self, newstate):
         self._on_pin(0, newstate)
@@ -73,14 +98,31 @@ class Wiegand:
 
     def read_card(self):
         # compatible interface with our urdm6300 library
-        if self._last_card is None:
-            return None
-
-        card_uid = self._get_card_uid()
-
-        self._last_card = None
+        # returns the card UID as an int (or None), never a string
+        event = self.read_event()
+        return None if event is None else event[0]
 
-        return card_uid
+    def read_event(self):
+        """
+        Take the oldest card read from the buffer. Returns (card UID, ticks_ms
+        of the swipe), or None if there are no cards waiting.
+        """
+        tail = self._event_tail
+        if tail == self._event_head:
+            return None
+        event = self._event_uids[tail], self._event_times[tail]
+        self._event_tail = (tail + 1) % len(self._event_uids)
+        return event
+
+    def _push_event(self, card_uid, ticks):
+        head = self._event_head
+        next_head = (head + 1) % len(self._event_uids)
+        if next_head == self._event_tail:
+            self.cards_dropped += 1
+            return
+        self._event_uids[head] = card_uid
+        self._event_times[head] = ticks
+        self._event_head = next_head
 
     def _get_card_uid(self):
         if self._last_card is None:
@@ -102,11 +144,13 @@ class Wiegand:
         now = utime.ticks_ms()
         if now - self._last_bit_read > 100:
             # too slow - new start!
+            swiped = self._last_bit_read
             self._last_bit_read = None
             self._last_card = self._next_card
             self._next_card = 0
             self._bits = 0
             self.cards_read += 1
+            self._push_event(self._get_card_uid(), swiped)
 
             if self._callback:
                 self._callback(
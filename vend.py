@@ -0,0 +1,110 @@
+"""
+vend.py - vend cycle state machine
+
+Vending used to block the main loop: "toggle" mode slept while the relay was
+on, and "hold" mode waited for the machine's accept coins signal to go low
+with no timeout, so a machine that never vended stopped the websocket, the
+reader and the WDT feeds until the WDT reset the device. Vend keeps track of
+the cycle instead, and a scheduler task calls update() to move it along:
+
+    IDLE -> VENDING -> IDLE
+
+- "toggle" mode: the relay is held on for toggle_ms.
+- "hold" mode: the relay is held on until accepting() goes False, checked
+  from settle_ms after the start so the machine has time to raise it. If
+  it's still True after timeout_ms the vend has failed, and the card should
+  be refunded.
+"""
+
+import time
+
+IDLE = "idle"
+VENDING = "vending"
+
+MODE_TOGGLE = "toggle"
+MODE_HOLD = "hold"
+
+
+class Vend:
+    def __init__(
+        self,
+        on_start,
+        on_stop,
+        accepting=None,
+        mode=MODE_TOGGLE,
+        toggle_ms=1000,
+        settle_ms=1000,
+        timeout_ms=60000,
+    ):
+        """
+        on_start   - called to start vending (turn the vend relay on)
+        on_stop    - called to stop vending
+        accepting  - returns True while the machine's accept coins signal
+                     says it's vending, for "hold" mode
+        mode       - "toggle" or "hold"
+        toggle_ms  - how long to hold the relay on in "toggle" mode
+        settle_ms  - how long to wait before checking accepting()
+        timeout_ms - how long to wait for accepting() to go False
+        """
+        self._on_start = on_start
+        self._on_stop = on_stop
+        self._accepting = accepting
+        self.mode = mode
+        self.toggle_ms = toggle_ms
+        self.settle_ms = settle_ms
+        self.timeout_ms = timeout_ms
+
+        self.state = IDLE
+        self.card_id = None  # who paid for the vend in progress
+        self.amount = None  # what they paid, in cents
+        self._started = None  # ticks_ms the vend started
+
+    @property
+    def busy(self):
+        return self.state != IDLE
+
+    def start(self, card_id, amount):
+        """
+        Start vending for card_id, who's paid amount. Returns False if a vend
+        is already in progress.
+        """
+        if self.busy:
+            return False
+        self.card_id = card_id
+        self.amount = amount
+        self._started = time.ticks_ms()
+        self.state = VENDING
+        self._on_start()
+        return True
+
+    def stop(self):
+        """Stop vending now."""
+        self._started = None
+        self.state = IDLE
+        self._on_stop()
+
+    def update(self):
+        """
+        Stop vending if it's done. Returns "vended", "timeout" if the machine
+        didn't vend in time, or None if it's still vending (or idle).
+        """
+        if self.state == IDLE:
+            return None
+
+        elapsed = time.ticks_diff(time.ticks_ms(), self._started)
+        if self.mode == MODE_HOLD:
+            if elapsed < self.settle_ms:
+                return None
+            if not self._accepting():
+                result = "vended"
+            elif elapsed >= self.timeout_ms:
+                result = "timeout"
+            else:
+                return None
+        elif elapsed < self.toggle_ms:
+            return None
+        else:
+            result = "vended"
+
+        self.stop()
+        return result